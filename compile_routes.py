@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+'''
+Resolves every route in routes.json through the Google Maps APIs once and
+writes the resulting waypoints to a file runserver.py can walk without
+talking to Google (runserver.py --waypoints waypoints.bin).
+'''
+
+import json
+import logging
+import argparse
+
+from pogom import config
+from pogom.waypoints import get_route_waypoints, write_waypoints
+
+logging.basicConfig(format='%(asctime)s [%(module)14s] [%(levelname)7s] %(message)s')
+log = logging.getLogger()
+log.setLevel(logging.INFO)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-k', '--gmaps-key', required=True,
+                        help='Google Maps API Key')
+    parser.add_argument('-r', '--routes', default='routes.json',
+                        help='Routes file to compile (default: routes.json)')
+    parser.add_argument('-o', '--output', default='waypoints.bin',
+                        help='Waypoint file to write (default: waypoints.bin)')
+    parser.add_argument('-s', '--speed', type=float, default=11,
+                        help='Walking speed in m/s used to space waypoints (default: 11)')
+    parser.add_argument('--maps-cache', default='maps_cache.db',
+                        help='File to cache Google Maps results in (default: maps_cache.db, empty to disable)')
+    parser.add_argument('--no-elevation', action='store_true', default=False,
+                        help='Skip the Google Elevation API and store altitude 0')
+    args = parser.parse_args()
+
+    config['GMAPS_KEY'] = args.gmaps_key
+    config['MAPS_CACHE'] = args.maps_cache
+    config['MAPS_ELEVATION'] = not args.no_elevation
+
+    routes = json.loads(open(args.routes).read())['routes']
+
+    compiled = []
+    for i, route in enumerate(routes):
+        waypoints = get_route_waypoints(route, args.speed)
+        log.info('Route {}: {} waypoints'.format(i, len(waypoints)))
+        compiled.append(waypoints)
+
+    write_waypoints(args.output, compiled)
+    log.info('Wrote {} routes to {}.'.format(len(compiled), args.output))
@@ -8,8 +8,42 @@ config = {
     'ORIGINAL_LATITUDE': None,
     'ORIGINAL_LONGITUDE': None,
     'GMAPS_KEY': None,
+    'MAPS_CACHE': None,
+    'MAPS_CACHE_TTL': 30 * 24 * 3600,
+    'MAPS_ELEVATION': True,
     'REQ_SLEEP': 5,
     'REQ_HEAVY_SLEEP': 30,
     'REQ_MAX_FAILED': 5,
+    'RATE_ACCOUNT_MAX': 0.5,
+    'RATE_ENDPOINT': 20,
+    'RATE_ENDPOINT_MAX': 50,
+    'RATE_INCREASE': 0.01,
+    'RATE_DECREASE': 0.5,
+    'RATE_WINDOW': 10,
+    'RATE_FAILED_RATIO': 0.2,
+    'SYNC_OVERLAP': 10,
+    'CLEANUP_INTERVAL': 300,
+    'CLEANUP_BATCH_SIZE': 500,
+    'INGEST_QUEUE_SIZE': 1000,
+    'INGEST_FLUSH_ROWS': 500,
+    'INGEST_FLUSH_INTERVAL': 2,
+    'INGEST_MAX_FAILED': 3,
+    'WH_QUEUE_SIZE': 10000,
+    'WH_RETRIES': 3,
+    'WH_TIMEOUT': 5,
+    'ACCOUNT_REFRESH_MARGIN': 300,
+    'ACCOUNT_TOKEN_LIFETIME': 1800,
+    'ACCOUNT_LOGIN_THREADS': 4,
+    'SCHEDULER_BATCH_SIZE': 20,
+    'SHARD_REPORT_INTERVAL': 60,
+    'LEASE_TTL': 60,
+    'LEASE_HEARTBEAT': 15,
+    'SCAN_RADIUS': 70,
+    'COVERAGE_WINDOW': 60,
+    'COVERAGE_RATIO': 0.9,
+    'SPAWN_DURATION': 900,
+    'SPAWN_DELAY': 10,
+    'SPAWN_TICK': 10,
+    'SPAWN_RELOAD': 600,
     'PASSWORD': None
 }
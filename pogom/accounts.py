@@ -0,0 +1,147 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from threading import Thread, Event
+from queue import Queue
+
+from pgoapi import PGoApi
+from pgoapi.token_store import TokenStore
+
+from . import config
+
+log = logging.getLogger(__name__)
+
+account_pool = None
+
+
+def start_account_pool(args):
+    global account_pool
+    account_pool = AccountPool(args.pgousers, args.auth_service,
+                               args.login_delay, args.token_file)
+    account_pool.start()
+    return account_pool
+
+
+class AccountPool(object):
+    '''
+    Keeps a logged in PGoApi for every routes.json account. Tokens are
+    refreshed ACCOUNT_REFRESH_MARGIN seconds before they expire and the
+    fresh PGoApi is swapped in, so search threads never wait on a login
+    once their account came up. One thread schedules the logins, which
+    ACCOUNT_LOGIN_THREADS threads then carry out, so a slow login server
+    only holds up some of them.
+
+    Tokens are kept encrypted in the token file, so after a restart the
+    accounts whose token is still valid log in without any network round
+    trip.
+
+    Search threads invalidate() an account whose requests keep failing,
+    which logs it in again right away, without its saved token.
+    '''
+
+    def __init__(self, users, auth_service, login_delay, token_file=None):
+        self.auth_service = auth_service
+        self.login_delay = login_delay
+        self.token_store = None
+        if token_file:
+            # Saved tokens about to expire are not reused, or the refresh
+            # would just get the same token back
+            self.token_store = TokenStore(token_file,
+                                          config['ACCOUNT_REFRESH_MARGIN'])
+
+        self.accounts = [{'username': username,
+                          'password': password,
+                          'api': None,
+                          'ready': Event(),
+                          'refresh_at': 0,
+                          'refreshing': False,
+                          'invalidated': False}
+                         for username, password in users]
+        self._wakeup = Event()
+        self._logins = Queue()
+
+    def start(self):
+        t = Thread(target=self._refresh_loop, name='account_thread')
+        t.daemon = True
+        t.start()
+        for i in range(config['ACCOUNT_LOGIN_THREADS']):
+            t = Thread(target=self._login_thread, name='login_thread-{}'.format(i))
+            t.daemon = True
+            t.start()
+
+    def get(self, i, block=True):
+        # Blocks only until the account's first login, afterwards the
+        # current session is returned straight away
+        account = self.accounts[i]
+        if not block and not account['ready'].is_set():
+            return None
+        account['ready'].wait()
+        return account['api']
+
+    def invalidate(self, i):
+        # The token may have been revoked early, or a restored one was stale
+        account = self.accounts[i]
+        if (account['invalidated'] or account['refreshing'] or
+                not account['ready'].is_set()):
+            return
+        account['invalidated'] = True
+        log.info('Requests of {} keep failing, logging in again.'.format(
+            account['username']))
+        if self.token_store:
+            self.token_store.delete(self.auth_service, account['username'])
+        account['refresh_at'] = 0
+        self._wakeup.set()
+
+    def _refresh_loop(self):
+        while True:
+            now = time.time()
+            waiting = [a for a in self.accounts if not a['refreshing']]
+            for account in waiting:
+                if account['refresh_at'] <= now:
+                    account['refreshing'] = True
+                    self._logins.put(account)
+
+            # Woken early by invalidate() and finished logins
+            pending = [a['refresh_at'] for a in self.accounts
+                       if not a['refreshing']]
+            self._wakeup.wait(min(pending) - now if pending else None)
+            self._wakeup.clear()
+
+    def _login_thread(self):
+        while True:
+            account = self._logins.get()
+            if not self._login(account):
+                log.info('Failed to login {}. Trying again in {:g} seconds.'
+                         .format(account['username'], self.login_delay))
+                account['refresh_at'] = time.time() + self.login_delay
+            account['refreshing'] = False
+            self._wakeup.set()
+
+    def _login(self, account):
+        api = PGoApi(token_store=self.token_store)
+        api.set_position(config['ORIGINAL_LATITUDE'],
+                         config['ORIGINAL_LONGITUDE'], 0)
+        try:
+            if not api.login(self.auth_service, account['username'],
+                             account['password']):
+                return False
+        except Exception as e:
+            log.warning('Login of {} raised {}'.format(account['username'], e))
+            return False
+
+        expire = api._auth_provider.get_token_expire()
+        if not expire:
+            expire = time.time() + config['ACCOUNT_TOKEN_LIFETIME']
+
+        old_api, account['api'] = account['api'], api
+        account['refresh_at'] = expire - config['ACCOUNT_REFRESH_MARGIN']
+        account['invalidated'] = False
+        account['ready'].set()
+        if old_api is not None:
+            old_api.close()
+        log.info('Logged in {}, token valid for {:.0f} minutes.'.format(
+            account['username'], (expire - time.time()) / 60))
+        return True
@@ -7,12 +7,12 @@ import logging
 from flask import Flask, jsonify, render_template, request
 from flask.json import JSONEncoder
 from flask_compress import Compress
-from datetime import datetime
+from datetime import datetime, timedelta
 from s2sphere import *
 from pogom.utils import get_args
 
 from . import config
-from .models import Pokemon, Gym, Pokestop, ScannedLocation
+from .models import Pokemon, Gym, Pokestop, ScannedLocation, ScanNode
 
 log = logging.getLogger(__name__)
 compress = Compress()
@@ -21,6 +21,7 @@ compress = Compress()
 class Pogom(Flask):
     def __init__(self, import_name, **kwargs):
         super(Pogom, self).__init__(import_name, **kwargs)
+        self.args = get_args()
         compress.init_app(self)
         self.json_encoder = CustomJSONEncoder
         self.route("/", methods=['GET'])(self.fullmap)
@@ -28,11 +29,11 @@ class Pogom(Flask):
         self.route("/loc", methods=['GET'])(self.loc)
         self.route("/next_loc", methods=['POST'])(self.next_loc)
         self.route("/mobile", methods=['GET'])(self.list_pokemon)
+        self.route("/nodes", methods=['GET'])(self.nodes)
 
     def fullmap(self):
-        args = get_args()
         display = "inline"
-        if args.fixed_location:
+        if self.args.fixed_location:
             display = "none"
 
         return render_template('map.html',
@@ -49,26 +50,43 @@ class Pogom(Flask):
         swLng = request.args.get('swLng')
         neLat = request.args.get('neLat')
         neLng = request.args.get('neLng')
+
+        # Clients pass back the timestamp of their previous response as
+        # `since` and only receive rows written after it. The overlap covers
+        # rows whose transaction was stamped before but committed after that
+        # response.
+        d['timestamp'] = datetime.utcnow()
+        since = request.args.get('since', type=int)
+        if since is not None:
+            since = (datetime.utcfromtimestamp(since / 1000.0) -
+                     timedelta(seconds=config['SYNC_OVERLAP']))
+
         if request.args.get('pokemon', 'true') == 'true':
             if request.args.get('ids'):
                 ids = [int(x) for x in request.args.get('ids').split(',')]
                 d['pokemons'] = Pokemon.get_active_by_id(ids, swLat, swLng,
-                                                         neLat, neLng)
+                                                         neLat, neLng, since)
             else:
-                d['pokemons'] = Pokemon.get_active(swLat, swLng, neLat, neLng)
+                d['pokemons'] = Pokemon.get_active(swLat, swLng, neLat, neLng,
+                                                   since)
 
         if request.args.get('pokestops', 'false') == 'true':
-            d['pokestops'] = Pokestop.get_stops(swLat, swLng, neLat, neLng)
+            d['pokestops'] = Pokestop.get_stops(swLat, swLng, neLat, neLng,
+                                                since)
 
         if request.args.get('gyms', 'true') == 'true':
-            d['gyms'] = Gym.get_gyms(swLat, swLng, neLat, neLng)
+            d['gyms'] = Gym.get_gyms(swLat, swLng, neLat, neLng, since)
 
         if request.args.get('scanned', 'true') == 'true':
             d['scanned'] = ScannedLocation.get_recent(swLat, swLng, neLat,
-                                                      neLng)
+                                                      neLng, since)
 
         return jsonify(d)
 
+    def nodes(self):
+        # Scanner nodes of a --coordinate setup, with their throughput
+        return jsonify({'nodes': ScanNode.get_nodes()})
+
     def loc(self):
         d = {}
         d['lat'] = config['ORIGINAL_LATITUDE']
@@ -77,8 +95,7 @@ class Pogom(Flask):
         return jsonify(d)
 
     def next_loc(self):
-        args = get_args()
-        if args.fixed_location:
+        if self.args.fixed_location:
             return 'Location searching is turned off', 403
         # part of query string
         if request.args:
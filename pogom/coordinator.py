@@ -0,0 +1,150 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Coordination Architecture:
+ - Every route in routes.json has a row in the shared database's lease
+   table, naming the node that scans it and until when
+ - Each node renews its leases every LEASE_HEARTBEAT seconds; leases that
+   were not renewed for LEASE_TTL seconds (a dead node) are free to be
+   taken over
+ - A node holds at most its fair share of routes, as many as it has
+   accounts and no more than the routes divided by the live nodes, and
+   hands back the rest
+ - Each heartbeat also records the node's scan throughput, see /nodes
+'''
+
+import logging
+import math
+import time
+
+from datetime import datetime, timedelta
+from threading import Thread, Lock
+from peewee import IntegrityError, InsertQuery
+
+from . import config
+from .models import RouteLease, ScanNode
+
+log = logging.getLogger(__name__)
+
+coordinator = None
+
+
+def start_coordinator(args, node_id, scheduler):
+    global coordinator
+    coordinator = Coordinator(node_id, len(args.routes), len(args.pgousers),
+                              scheduler)
+    coordinator.start()
+    return coordinator
+
+
+class Coordinator(object):
+
+    def __init__(self, node_id, num_routes, capacity, scheduler):
+        self.node_id = node_id
+        self.num_routes = num_routes
+        self.capacity = capacity
+        self.scheduler = scheduler
+
+        self._lock = Lock()
+        self._leases = set()
+        self._valid_until = None
+
+        self._completed = 0
+        self._last_heartbeat = time.time()
+
+    def start(self):
+        self._create_leases()
+        # Lease right away, so the first search loop has routes to scan
+        self._heartbeat()
+        t = Thread(target=self._heartbeat_loop, name='lease_thread')
+        t.daemon = True
+        t.start()
+
+    def routes(self):
+        # Leases we could not renew in time may already be someone else's
+        with self._lock:
+            if self._valid_until is None or self._valid_until < datetime.utcnow():
+                return []
+            return sorted(self._leases)
+
+    def _create_leases(self):
+        existing = set(r.route for r in RouteLease.select(RouteLease.route))
+        for route in range(self.num_routes):
+            if route in existing:
+                continue
+            try:
+                RouteLease.insert(route=route).execute()
+            except IntegrityError:
+                # Another node created it in the meantime
+                pass
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(config['LEASE_HEARTBEAT'])
+            try:
+                self._heartbeat()
+            except Exception as e:
+                log.warning('Lease heartbeat failed: {}'.format(e))
+
+    def _heartbeat(self):
+        now = datetime.utcnow()
+        expires = now + timedelta(seconds=config['LEASE_TTL'])
+
+        # This node's own row is only written after the leases are updated
+        nodes = ScanNode.count_alive(exclude=self.node_id) + 1
+        share = int(math.ceil(float(self.num_routes) / nodes))
+        target = min(self.capacity, share)
+
+        with self._lock:
+            held = sorted(self._leases)
+
+        leases = set()
+        for route in held:
+            if len(leases) >= target:
+                RouteLease.update(node_id=None, expires=None).where(
+                    (RouteLease.route == route) &
+                    (RouteLease.node_id == self.node_id)).execute()
+                log.info('Released route {} to other nodes.'.format(route))
+            elif RouteLease.update(expires=expires).where(
+                    (RouteLease.route == route) &
+                    (RouteLease.node_id == self.node_id)).execute():
+                leases.add(route)
+            else:
+                log.warning('Lost the lease on route {}.'.format(route))
+
+        if len(leases) < target:
+            # Nodes with a longer routes.json may have created leases for
+            # routes this one doesn't have
+            free = (((RouteLease.node_id >> None) | (RouteLease.expires < now)) &
+                    (RouteLease.route < self.num_routes))
+            query = (RouteLease
+                     .select(RouteLease.route)
+                     .where(free)
+                     .order_by(RouteLease.route))
+            for lease in list(query):
+                if len(leases) >= target:
+                    break
+                # Only one node's update matches while the lease is free
+                if RouteLease.update(node_id=self.node_id, expires=expires).where(
+                        (RouteLease.route == lease.route) & free).execute():
+                    leases.add(lease.route)
+                    log.info('Leased route {}.'.format(lease.route))
+
+        with self._lock:
+            self._leases = leases
+            self._valid_until = expires
+
+        self._report(now)
+
+    def _report(self, now):
+        completed = self.scheduler.completed
+        rate = (completed - self._completed) / max(1, time.time() - self._last_heartbeat)
+        self._completed = completed
+        self._last_heartbeat = time.time()
+
+        InsertQuery(ScanNode, rows=[{'node_id': self.node_id,
+                                     'routes': len(self._leases),
+                                     'waypoints': completed,
+                                     'rate': rate,
+                                     'last_heartbeat': now}]).upsert().execute()
@@ -0,0 +1,102 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Ingestion Architecture:
+ - Search threads parse map responses into rows and put them on ingest_queue
+ - A single writer thread drains the queue, merging rows from many responses
+   by primary key, and upserts them once enough rows are pending or the
+   oldest pending row has waited INGEST_FLUSH_INTERVAL seconds
+ - A flush that failed INGEST_MAX_FAILED times in a row is written one row at
+   a time instead, dropping only the rows that still fail
+'''
+
+import logging
+import time
+
+from queue import Queue, Empty
+
+from . import config
+from .models import write_map_data
+
+log = logging.getLogger(__name__)
+
+ingest_queue = Queue(maxsize=config['INGEST_QUEUE_SIZE'])
+
+
+def ingest_loop():
+    pending = {}
+    num_responses = 0
+    first_pending = None
+    failed_flushes = 0
+    dropped = 0
+
+    while True:
+        if first_pending is None:
+            timeout = None
+        else:
+            timeout = max(0, first_pending +
+                          config['INGEST_FLUSH_INTERVAL'] - time.time())
+
+        try:
+            data = ingest_queue.get(timeout=timeout)
+            for model, rows in data.iteritems():
+                pending.setdefault(model, {}).update(rows)
+            num_responses += 1
+            if first_pending is None:
+                first_pending = time.time()
+            ingest_queue.task_done()
+        except Empty:
+            pass
+
+        num_rows = sum(len(rows) for rows in pending.itervalues())
+        if not num_rows:
+            continue
+        if (num_rows < config['INGEST_FLUSH_ROWS'] and
+                time.time() - first_pending < config['INGEST_FLUSH_INTERVAL']):
+            continue
+
+        start = time.time()
+        try:
+            write_map_data(pending)
+            failed_flushes = 0
+        except Exception as e:
+            log.error('Ingest flush error @ {0.__class__.__name__}: {0}'
+                      .format(e))
+            failed_flushes += 1
+            if failed_flushes < config['INGEST_MAX_FAILED']:
+                # Keep the rows around, the next flush will try them again
+                time.sleep(1)
+                continue
+
+            # Probably a row the database refuses, don't let it hold up the
+            # others any longer
+            failed_flushes = 0
+            num_dropped = write_rows_singly(pending)
+            num_rows -= num_dropped
+            dropped += num_dropped
+            log.error('Dropped {} rows that could not be written, {} since '
+                      'startup.'.format(num_dropped, dropped))
+
+        log.info('Wrote {} rows from {} responses in {:.0f}ms '
+                 '({:.1f}s after the first, {} responses queued)'.format(
+                     num_rows, num_responses, (time.time() - start) * 1000,
+                     start - first_pending, ingest_queue.qsize()))
+
+        pending = {}
+        num_responses = 0
+        first_pending = None
+
+
+def write_rows_singly(pending):
+    # Returns the number of rows that failed and were dropped
+    num_dropped = 0
+    for model, rows in pending.iteritems():
+        for key, row in rows.iteritems():
+            try:
+                write_map_data({model: {key: row}})
+            except Exception as e:
+                log.warning('Dropping {0} {1} @ {2.__class__.__name__}: {2}'
+                            .format(model.__name__, key, e))
+                num_dropped += 1
+    return num_dropped
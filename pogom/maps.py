@@ -75,38 +75,151 @@ Cons:
 
 Oh, and DO WHAT THE FUCK YOU WANT WITH THIS.
 '''
+import json
+import logging
+import sqlite3
+import time
+from functools import wraps
+from threading import Lock
+import numpy as np
 from urllib import urlencode
 from requests import get
 from . import config
 
+log = logging.getLogger(__name__)
 
+_cache_db = None
+_cache_lock = Lock()
+
+
+def _cache_connection():
+    global _cache_db
+    if _cache_db is None:
+        _cache_db = sqlite3.connect(config['MAPS_CACHE'],
+                                    check_same_thread=False)
+        _cache_db.execute('CREATE TABLE IF NOT EXISTS maps_cache '
+                          '(key TEXT PRIMARY KEY, value TEXT, created REAL)')
+    return _cache_db
+
+
+def _cached(func):
+    '''
+    Keep results on disk, keyed on the function name and its arguments, so
+    routes only hit the Google APIs once per MAPS_CACHE_TTL. An expired
+    result is still used when fetching a fresh one fails.
+    '''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not config['MAPS_CACHE']:
+            return func(*args, **kwargs)
+
+        key = json.dumps([func.__name__, args, sorted(kwargs.items())])
+        with _cache_lock:
+            row = _cache_connection().execute(
+                'SELECT value, created FROM maps_cache WHERE key = ?',
+                (key,)).fetchone()
+
+        stale = None
+        if row is not None:
+            value = _from_json(json.loads(row[0]))
+            if time.time() - row[1] < config['MAPS_CACHE_TTL']:
+                return value
+            stale = value
+
+        try:
+            value = func(*args, **kwargs)
+        except Exception as e:
+            if stale is None:
+                raise
+            log.warning('{} failed ({}), using expired cached result'.format(
+                func.__name__, e))
+            return stale
+
+        # Empty paths come from failed or incomplete lookups as well, don't
+        # keep them around for MAPS_CACHE_TTL
+        if value is None or value == []:
+            return value if stale is None else stale
+
+        with _cache_lock:
+            db = _cache_connection()
+            db.execute('INSERT OR REPLACE INTO maps_cache VALUES (?, ?, ?)',
+                       (key, json.dumps(value), time.time()))
+            db.commit()
+        return value
+
+    return wrapper
+
+
+def _from_json(value):
+    # Coordinates are tuples everywhere, JSON turns them into lists
+    if isinstance(value, list):
+        if not value or isinstance(value[0], list):
+            return [tuple(v) for v in value]
+        return tuple(value)
+    return value
 
 
 def _fetch(api, args):
+    # Errors such as OVER_QUERY_LIMIT come back as a response without
+    # results, raise so they aren't mistaken for one
     base_url = 'https://maps.googleapis.com/maps/api/%s/json?key=%s&'
-    return get(base_url % (api, config['GMAPS_KEY']) + urlencode(args)).json()
-
-def _decode(polyline):
-    values, current = [], []
-    for byte in bytearray(polyline, 'ascii'):
-        byte -= 63
-        current.append(byte & 0x1f)
-        if byte & 0x20:
-            continue
-        value = 0
-        for chunk in reversed(current):
-            value <<= 5
-            value |= chunk
-        values.append(((~value if value & 0x1 else value) >> 1) / 100000.)
-        current = []
-    result, x, y = [], 0., 0.
-    for dx, dy in [tuple(values[i:i+2]) for i in range(0, len(values), 2)]:
-        x, y = x + dx, y + dy
-        result.append((round(x, 6), round(y, 6)))
+    result = get(base_url % (api, config['GMAPS_KEY']) + urlencode(args)).json()
+    if result.get('status', 'OK') != 'OK':
+        raise ValueError('{} API returned {}: {}'.format(
+            api, result['status'], result.get('error_message', '')))
     return result
 
+EARTH_RADIUS = 6371000.
+ELEVATION_MAX_SAMPLES = 512
 
-
+def _decode(polyline):
+    # Every value is a run of 5 bit chunks, least significant first, where
+    # all but the last chunk have the 0x20 continuation bit set
+    data = np.frombuffer(polyline.encode('ascii'), dtype=np.uint8) - 63
+    ends = np.flatnonzero((data & 0x20) == 0)
+    starts = np.r_[0, ends[:-1] + 1]
+    value_index = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shifts = (np.arange(len(data)) - starts[value_index]) * 5
+    values = np.bincount(value_index,
+                         weights=(data & 0x1f).astype(np.int64) << shifts)
+    values = values.astype(np.int64)
+    values = np.where(values & 0x1, ~values, values) >> 1
+    return (np.cumsum(values.reshape(-1, 2), axis=0) / 100000.).round(6)
+
+def _resample(points, spacing):
+    # Evenly spaced points along the great circle segments of a decoded
+    # polyline, about 'spacing' meters apart and including both ends
+    if len(points) < 2:
+        return points
+    lat, lng = np.radians(points[:, 0]), np.radians(points[:, 1])
+    xyz = np.column_stack((np.cos(lat) * np.cos(lng),
+                           np.cos(lat) * np.sin(lng),
+                           np.sin(lat)))
+    angles = np.arccos(np.clip((xyz[:-1] * xyz[1:]).sum(axis=1), -1, 1))
+    distance = np.r_[0, np.cumsum(angles)]
+
+    samples = max(2, int(distance[-1] * EARTH_RADIUS / spacing) + 1)
+    targets = np.linspace(0, distance[-1], samples)
+    segment = np.searchsorted(distance, targets, side='right') - 1
+    segment = np.clip(segment, 0, len(angles) - 1)
+
+    # Spherical interpolation within each segment, linear for the (zero
+    # length) segments where that would divide by zero
+    theta = angles[segment]
+    moving = theta > 1e-12
+    safe_theta = np.where(moving, theta, 1)
+    f = np.where(moving, (targets - distance[segment]) / safe_theta, 0)
+    a = np.where(moving, np.sin((1 - f) * theta) / np.sin(safe_theta), 1 - f)
+    b = np.where(moving, np.sin(f * theta) / np.sin(safe_theta), f)
+    v = a[:, None] * xyz[segment] + b[:, None] * xyz[segment + 1]
+
+    return np.column_stack((
+        np.degrees(np.arctan2(v[:, 2], np.hypot(v[:, 0], v[:, 1]))),
+        np.degrees(np.arctan2(v[:, 1], v[:, 0]))))
+
+
+
+@_cached
 def coordinates(location):
     '''
     Get the coordinates of a given location.
@@ -128,11 +241,13 @@ def coordinates(location):
 
     return result['lat'], result['lng']
 
+@_cached
 def getElevation(coords):
     result = _fetch('elevation',{'locations':'{},{}'.format(coords[0],coords[1])})
     return (coords[0],coords[1],result['results'][0]['elevation'])
     
-def path(origin, destination = None, mode = 'walking', samplefreq=12,speed=3.1):
+@_cached
+def path(origin, destination = None, mode = 'walking', samplefreq=12,speed=3.1, elevation=True):
     '''
     Find a not-so-long path from somewhere to somewhere else.
 
@@ -142,6 +257,10 @@ def path(origin, destination = None, mode = 'walking', samplefreq=12,speed=3.1):
         >>> path(coordinates('Paris'), coordinates('London'))
         [(48.85668, 2.35196), (48.86142, 2.33929), (48.86897, 2.32369), ...
 
+    Points are spaced 'samplefreq' * 'speed' meters apart along the route.
+    Their altitudes come from the Elevation API, or are 0 if 'elevation' is
+    False.
+
     Returns a list of coordinates to follow, or None if it didn't work either.
     '''
     args = {'mode': mode}
@@ -157,18 +276,26 @@ def path(origin, destination = None, mode = 'walking', samplefreq=12,speed=3.1):
     result = _fetch('directions', args)
     # You can extract other useful informations here, such as duration
     
-    distance = 0
-    for leg in result['routes'][0]['legs']:
-        distance = distance + leg['distance']["value"]
+    polyline = result['routes'][0]['overview_polyline']['points']
     distancepersample = samplefreq*speed
-    samples = distance/distancepersample
-    print '{}m at {} meters per sample. {} samples'.format(distance,distancepersample, samples)
-    result = result['routes'][0]['overview_polyline']['points']
-    result = _fetch('elevation',{'path':'enc:{}'.format(result),'samples':long(samples)})
-    returnArray = []
-    for loc in result['results']:
-        returnArray.append((loc['location']['lat'],loc['location']['lng'],loc['elevation']))
+    points = _resample(_decode(polyline), distancepersample)
+    log.debug('{} points at {} meters per sample'.format(len(points), distancepersample))
+    if elevation:
+        # The Elevation API samples a path at most ELEVATION_MAX_SAMPLES
+        # times, longer legs are interpolated between those
+        samples = max(2, min(len(points), ELEVATION_MAX_SAMPLES))
+        result = _fetch('elevation',{'path':'enc:{}'.format(polyline),'samples':samples})
+        altitudes = [loc['elevation'] for loc in result['results']]
+        if len(altitudes) != samples:
+            log.warning('Elevation API returned {} of {} samples, walking '
+                        'at altitude 0 instead.'.format(len(altitudes), samples))
+            altitudes = [0.0] * len(points)
+        elif samples != len(points):
+            altitudes = np.interp(np.linspace(0, samples - 1, len(points)),
+                                  np.arange(samples), altitudes).tolist()
+    else:
+        altitudes = [0.0] * len(points)
+    returnArray = [(lat, lng, alt) for (lat, lng), alt in zip(points.tolist(), altitudes)]
     #except:
         #return None
-    print returnArray
     return returnArray
@@ -4,22 +4,31 @@
 import logging
 import os
 import time
+import json
+import gzip
 from peewee import Model, MySQLDatabase, SqliteDatabase, InsertQuery,\
                    IntegerField, CharField, DoubleField, BooleanField,\
                    DateTimeField, OperationalError
+from playhouse.migrate import migrate, MySQLMigrator, SqliteMigrator
 from datetime import datetime, timedelta
 from base64 import b64encode
 
 from . import config
 from .utils import get_pokemon_name, get_args, send_to_webhook
-from .transform import transform_from_wgs_to_gcj
+from .transform import transform_rows, fort_cache
 from .customLog import printPokemon
+from .spatial import GridIndex
 
 log = logging.getLogger(__name__)
 
 args = get_args()
 db = None
 
+# Live Pokemon as seen by this process' search threads. Only consulted once
+# enabled by load_pokemon_index(), i.e. when the searcher runs in-process
+# and is the database's only writer; everyone else keeps using the db.
+pokemon_index = GridIndex()
+
 
 def init_database():
     global db
@@ -34,7 +43,11 @@ def init_database():
             host=args.db_host)
         log.info('Connecting to MySQL database on {}.'.format(args.db_host))
     else:
-        db = SqliteDatabase(args.db)
+        # WAL lets the webserver keep reading while the ingest thread writes,
+        # and only needs an fsync per checkpoint instead of per transaction
+        db = SqliteDatabase(args.db, pragmas=(
+            ('journal_mode', 'wal'),
+            ('synchronous', 'normal')))
         log.info('Connecting to local SQLLite database.')
 
     return db
@@ -48,10 +61,8 @@ class BaseModel(Model):
     def get_all(cls):
         results = [m for m in cls.select().dicts()]
         if args.china:
-            for result in results:
-                result['latitude'], result['longitude'] = \
-                    transform_from_wgs_to_gcj(
-                        result['latitude'], result['longitude'])
+            transform_rows(results, fort_cache
+                           if cls in (Pokestop, Gym) else None)
         return results
 
 
@@ -64,9 +75,16 @@ class Pokemon(BaseModel):
     latitude = DoubleField()
     longitude = DoubleField()
     disappear_time = DateTimeField()
+    last_update = DateTimeField(null=True)
+
+    class Meta:
+        indexes = ((('disappear_time', 'latitude', 'longitude'), False),)
 
     @classmethod
-    def get_active(cls, swLat, swLng, neLat, neLng):
+    def get_active(cls, swLat, swLng, neLat, neLng, since=None):
+        if pokemon_index.enabled:
+            return cls.get_indexed(None, swLat, swLng, neLat, neLng, since)
+
         if swLat is None or swLng is None or neLat is None or neLng is None:
             query = (Pokemon
                      .select()
@@ -82,19 +100,25 @@ class Pokemon(BaseModel):
                             (Pokemon.longitude <= neLng))
                      .dicts())
 
+        if since is not None:
+            query = query.where(Pokemon.last_update > since)
+
         pokemons = []
         
         for p in query:
             p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
-            if args.china:
-                p['latitude'], p['longitude'] = \
-                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
             pokemons.append(p)
+
+        if args.china:
+            transform_rows(pokemons)
         
         return pokemons
 
     @classmethod
-    def get_active_by_id(cls, ids, swLat, swLng, neLat, neLng):
+    def get_active_by_id(cls, ids, swLat, swLng, neLat, neLng, since=None):
+        if pokemon_index.enabled:
+            return cls.get_indexed(ids, swLat, swLng, neLat, neLng, since)
+
         if swLat is None or swLng is None or neLat is None or neLng is None:
             query = (Pokemon
                      .select()
@@ -111,13 +135,42 @@ class Pokemon(BaseModel):
                             (Pokemon.latitude <= neLat) &
                             (Pokemon.longitude <= neLng))
                      .dicts())
+
+        if since is not None:
+            query = query.where(Pokemon.last_update > since)
+
         pokemons = []
         for p in query:
             p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
-            if args.china:
-                p['latitude'], p['longitude'] = \
-                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
             pokemons.append(p)
+
+        if args.china:
+            transform_rows(pokemons)
+        return pokemons
+
+    @classmethod
+    def get_indexed(cls, ids, swLat, swLng, neLat, neLng, since=None):
+        now = datetime.utcnow()
+        if swLat is None or swLng is None or neLat is None or neLng is None:
+            results = pokemon_index.all(now)
+        else:
+            results = pokemon_index.query(swLat, swLng, neLat, neLng, now)
+
+        pokemons = []
+        for p in results:
+            if ids is not None and p['pokemon_id'] not in ids:
+                continue
+            # Rows from before delta sync have no last_update, which the db
+            # query treats as unchanged too
+            if since is not None and (p['last_update'] is None or
+                                      not p['last_update'] > since):
+                continue
+            p = dict(p)
+            p['pokemon_name'] = get_pokemon_name(p['pokemon_id'])
+            pokemons.append(p)
+
+        if args.china:
+            transform_rows(pokemons)
         return pokemons
 
 
@@ -129,9 +182,13 @@ class Pokestop(BaseModel):
     last_modified = DateTimeField()
     lure_expiration = DateTimeField(null=True)
     active_pokemon_id = IntegerField(null=True)
+    last_update = DateTimeField(null=True)
+
+    class Meta:
+        indexes = ((('latitude', 'longitude'), False),)
 
     @classmethod
-    def get_stops(cls, swLat, swLng, neLat, neLng):
+    def get_stops(cls, swLat, swLng, neLat, neLng, since=None):
         if swLat is None or swLng is None or neLat is None or neLng is None:
             query = (Pokestop
                      .select()
@@ -145,13 +202,16 @@ class Pokestop(BaseModel):
                             (Pokestop.longitude <= neLng))
                      .dicts())
 
+        if since is not None:
+            query = query.where(Pokestop.last_update > since)
+
         pokestops = []
         for p in query:
-            if args.china:
-                p['latitude'], p['longitude'] = \
-                    transform_from_wgs_to_gcj(p['latitude'], p['longitude'])
             pokestops.append(p)
 
+        if args.china:
+            transform_rows(pokestops, fort_cache)
+
         return pokestops
 
 
@@ -169,9 +229,13 @@ class Gym(BaseModel):
     latitude = DoubleField()
     longitude = DoubleField()
     last_modified = DateTimeField()
+    last_update = DateTimeField(null=True)
+
+    class Meta:
+        indexes = ((('latitude', 'longitude'), False),)
 
     @classmethod
-    def get_gyms(cls, swLat, swLng, neLat, neLng):
+    def get_gyms(cls, swLat, swLng, neLat, neLng, since=None):
         if swLat is None or swLng is None or neLat is None or neLng is None:
             query = (Gym
                      .select()
@@ -185,10 +249,16 @@ class Gym(BaseModel):
                             (Gym.longitude <= neLng))
                      .dicts())
 
+        if since is not None:
+            query = query.where(Gym.last_update > since)
+
         gyms = []
         for g in query:
             gyms.append(g)
 
+        if args.china:
+            transform_rows(gyms, fort_cache)
+
         return gyms
 
 
@@ -198,12 +268,18 @@ class ScannedLocation(BaseModel):
     longitude = DoubleField()
     last_modified = DateTimeField()
 
+    class Meta:
+        indexes = ((('last_modified', 'latitude', 'longitude'), False),)
+
     @classmethod
-    def get_recent(cls, swLat, swLng, neLat, neLng):
+    def get_recent(cls, swLat, swLng, neLat, neLng, since=None):
+        oldest = datetime.utcnow() - timedelta(minutes=15)
+        if since is not None and since > oldest:
+            oldest = since
+
         query = (ScannedLocation
                  .select()
-                 .where((ScannedLocation.last_modified >=
-                        (datetime.utcnow() - timedelta(minutes=15))) &
+                 .where((ScannedLocation.last_modified >= oldest) &
                         (ScannedLocation.latitude >= swLat) &
                         (ScannedLocation.longitude >= swLng) &
                         (ScannedLocation.latitude <= neLat) &
@@ -217,126 +293,360 @@ class ScannedLocation(BaseModel):
         return scans
 
 
+class Spawnpoint(BaseModel):
+    spawnpoint_id = CharField(primary_key=True, max_length=50)
+    latitude = DoubleField()
+    longitude = DoubleField()
+    # Second of the hour the spawn point's Pokemon appear at
+    spawn_second = IntegerField()
+    last_update = DateTimeField()
+
+    class Meta:
+        indexes = ((('latitude', 'longitude'), False),)
+
+    @classmethod
+    def get_spawnpoints(cls):
+        query = (Spawnpoint
+                 .select()
+                 .order_by(Spawnpoint.spawnpoint_id)
+                 .dicts())
+
+        spawnpoints = []
+        for s in query:
+            spawnpoints.append(s)
+
+        return spawnpoints
+
+
+class RouteLease(BaseModel):
+    # Index of the route in routes.json, leased to one scanner node at a time
+    route = IntegerField(primary_key=True)
+    node_id = CharField(null=True, max_length=100)
+    expires = DateTimeField(null=True)
+
+
+class ScanNode(BaseModel):
+    node_id = CharField(primary_key=True, max_length=100)
+    routes = IntegerField()
+    waypoints = IntegerField()
+    rate = DoubleField()
+    last_heartbeat = DateTimeField()
+
+    @classmethod
+    def get_nodes(cls):
+        alive = datetime.utcnow() - timedelta(seconds=config['LEASE_TTL'])
+        nodes = []
+        for n in ScanNode.select().order_by(ScanNode.node_id).dicts():
+            n['alive'] = n['last_heartbeat'] > alive
+            nodes.append(n)
+        return nodes
+
+    @classmethod
+    def count_alive(cls, exclude=None):
+        alive = datetime.utcnow() - timedelta(seconds=config['LEASE_TTL'])
+        query = ScanNode.select().where(ScanNode.last_heartbeat > alive)
+        if exclude is not None:
+            query = query.where(ScanNode.node_id != exclude)
+        return query.count()
+
+
 def parse_map(map_dict, iteration_num, step, step_location):
     pokemons = {}
     pokestops = {}
     gyms = {}
     scanned = {}
+    spawnpoints = {}
+
+    # GET_MAP_OBJECTS is requested raw, so this is the decoded protobuf
+    # message rather than a dict. An empty cell list means the servers
+    # answered without data, which is retried just like a missing key.
+    cells = map_dict['responses']['GET_MAP_OBJECTS'].map_cells
+    if not cells:
+        raise KeyError('map_cells')
 
-    cells = map_dict['responses']['GET_MAP_OBJECTS']['map_cells']
     for cell in cells:
         if config['parse_pokemon']:
-            for p in cell.get('wild_pokemons', []):
+            for p in cell.wild_pokemons:
+                encounter_id = b64encode(str(p.encounter_id))
+                pokemon_id = p.pokemon_data.pokemon_id
                 d_t = datetime.utcfromtimestamp(
-                    (p['last_modified_timestamp_ms'] +
-                     p['time_till_hidden_ms']) / 1000.0)
-                printPokemon(p['pokemon_data']['pokemon_id'], p['latitude'],
-                             p['longitude'], d_t)
-                pokemons[p['encounter_id']] = {
-                    'encounter_id': b64encode(str(p['encounter_id'])),
-                    'spawnpoint_id': p['spawnpoint_id'],
-                    'pokemon_id': p['pokemon_data']['pokemon_id'],
-                    'latitude': p['latitude'],
-                    'longitude': p['longitude'],
+                    (p.last_modified_timestamp_ms +
+                     p.time_till_hidden_ms) / 1000.0)
+                printPokemon(pokemon_id, p.latitude, p.longitude, d_t)
+                pokemons[p.encounter_id] = {
+                    'encounter_id': encounter_id,
+                    'spawnpoint_id': p.spawnpoint_id,
+                    'pokemon_id': pokemon_id,
+                    'latitude': p.latitude,
+                    'longitude': p.longitude,
                     'disappear_time': d_t
                 }
 
                 webhook_data = {
-                    'encounter_id': b64encode(str(p['encounter_id'])),
-                    'spawnpoint_id': p['spawnpoint_id'],
-                    'pokemon_id': p['pokemon_data']['pokemon_id'],
-                    'latitude': p['latitude'],
-                    'longitude': p['longitude'],
+                    'encounter_id': encounter_id,
+                    'spawnpoint_id': p.spawnpoint_id,
+                    'pokemon_id': pokemon_id,
+                    'latitude': p.latitude,
+                    'longitude': p.longitude,
                     'disappear_time': time.mktime(d_t.timetuple())
                 }
 
                 send_to_webhook('pokemon', webhook_data)
 
+                # Pokemon stay for SPAWN_DURATION seconds, which dates their
+                # spawn if the timer is known. It is not when a sighting
+                # reports a negative or longer than possible time left.
+                if 0 < p.time_till_hidden_ms <= config['SPAWN_DURATION'] * 1000:
+                    appeared = (p.last_modified_timestamp_ms +
+                                p.time_till_hidden_ms) / 1000 - config['SPAWN_DURATION']
+                    spawnpoints[p.spawnpoint_id] = {
+                        'spawnpoint_id': p.spawnpoint_id,
+                        'latitude': p.latitude,
+                        'longitude': p.longitude,
+                        'spawn_second': int(appeared) % 3600
+                    }
+
         if iteration_num > 0 or step > 50:
-            for f in cell.get('forts', []):
-                if config['parse_pokestops'] and f.get('type') == 1:  # Pokestops
-                        if 'lure_info' in f:
+            for f in cell.forts:
+                if config['parse_pokestops'] and f.type == 1:  # Pokestops
+                        if f.HasField('lure_info'):
                             lure_expiration = datetime.utcfromtimestamp(
-                                f['lure_info']['lure_expires_timestamp_ms'] / 1000.0)
-                            active_pokemon_id = f['lure_info']['active_pokemon_id']
+                                f.lure_info.lure_expires_timestamp_ms / 1000.0)
+                            active_pokemon_id = f.lure_info.active_pokemon_id
                         else:
                             lure_expiration, active_pokemon_id = None, None
 
-                        pokestops[f['id']] = {
-                            'pokestop_id': f['id'],
-                            'enabled': f['enabled'],
-                            'latitude': f['latitude'],
-                            'longitude': f['longitude'],
+                        pokestops[f.id] = {
+                            'pokestop_id': f.id,
+                            'enabled': f.enabled,
+                            'latitude': f.latitude,
+                            'longitude': f.longitude,
                             'last_modified': datetime.utcfromtimestamp(
-                                f['last_modified_timestamp_ms'] / 1000.0),
+                                f.last_modified_timestamp_ms / 1000.0),
                             'lure_expiration': lure_expiration,
                             'active_pokemon_id': active_pokemon_id
                         }
 
-                elif config['parse_gyms'] and f.get('type') is None:  # Currently, there are only stops and gyms
-                        gyms[f['id']] = {
-                            'gym_id': f['id'],
-                            'team_id': f.get('owned_by_team', 0),
-                            'guard_pokemon_id': f.get('guard_pokemon_id', 0),
-                            'gym_points': f.get('gym_points', 0),
-                            'enabled': f['enabled'],
-                            'latitude': f['latitude'],
-                            'longitude': f['longitude'],
+                elif config['parse_gyms'] and f.type == 0:  # Currently, there are only stops and gyms
+                        gyms[f.id] = {
+                            'gym_id': f.id,
+                            'team_id': f.owned_by_team,
+                            'guard_pokemon_id': f.guard_pokemon_id,
+                            'gym_points': f.gym_points,
+                            'enabled': f.enabled,
+                            'latitude': f.latitude,
+                            'longitude': f.longitude,
                             'last_modified': datetime.utcfromtimestamp(
-                                f['last_modified_timestamp_ms'] / 1000.0),
+                                f.last_modified_timestamp_ms / 1000.0)
                         }
 
-    pokemons_upserted = 0
-    pokestops_upserted = 0
-    gyms_upserted = 0
-
-    if pokemons and config['parse_pokemon']:
-        pokemons_upserted = len(pokemons)
-        log.debug("Upserting {} pokemon".format(len(pokemons)))
-        bulk_upsert(Pokemon, pokemons)
+    scanned_id = str(step_location[0])+','+str(step_location[1])
+    scanned[scanned_id] = {
+        'scanned_id': scanned_id,
+        'latitude': step_location[0],
+        'longitude': step_location[1]
+    }
 
-    if pokestops and config['parse_pokestops']:
-        pokestops_upserted = len(pokestops)
-        log.debug("Upserting {} pokestops".format(len(pokestops)))
-        bulk_upsert(Pokestop, pokestops)
+    return {
+        Pokemon: pokemons,
+        Pokestop: pokestops,
+        Gym: gyms,
+        ScannedLocation: scanned,
+        Spawnpoint: spawnpoints
+    }
 
-    if gyms and config['parse_gyms']:
-        gyms_upserted = len(gyms)
-        log.debug("Upserting {} gyms".format(len(gyms)))
-        bulk_upsert(Gym, gyms)
 
-    log.info("Upserted {} pokemon, {} pokestops, and {} gyms".format(
-      pokemons_upserted,
-      pokestops_upserted,
-      gyms_upserted))
+# Lock wait timeout and deadlock, server gone away and lost connection.
+# SQLite reports contention as "database is locked" instead.
+MYSQL_LOCK_ERRORS = (1205, 1213)
+MYSQL_LOST_CONNECTION = (2006, 2013)
+
+
+def write_map_data(data):
+    pokemons = data.get(Pokemon)
+    pokestops = data.get(Pokestop)
+    gyms = data.get(Gym)
+    scanned = data.get(ScannedLocation)
+    spawnpoints = data.get(Spawnpoint)
+
+    # Everything is written in one transaction, which is retried as a whole
+    # with increasing delays while another connection holds the lock
+    delay = 0.5
+    while True:
+        # Every row gets the change stamp /raw_data compares the client's
+        # `since` cursor against right before it is committed, however long
+        # it waited in the ingest queue or for the lock. SYNC_OVERLAP only
+        # has to cover the transaction itself.
+        now = datetime.utcnow()
+        for model, rows in data.iteritems():
+            field = 'last_modified' if model is ScannedLocation else 'last_update'
+            for row in rows.itervalues():
+                row[field] = now
 
-    scanned[0] = {
-        'scanned_id': str(step_location[0])+','+str(step_location[1]),
-        'latitude': step_location[0],
-        'longitude': step_location[1],
-        'last_modified': datetime.utcnow(),
-    }
+        try:
+            with db.atomic():
+                if pokemons:
+                    log.debug("Upserting {} pokemon".format(len(pokemons)))
+                    bulk_upsert(Pokemon, pokemons)
+
+                if pokestops:
+                    log.debug("Upserting {} pokestops".format(len(pokestops)))
+                    bulk_upsert(Pokestop, pokestops)
+
+                if gyms:
+                    log.debug("Upserting {} gyms".format(len(gyms)))
+                    bulk_upsert(Gym, gyms)
+
+                if scanned:
+                    bulk_upsert(ScannedLocation, scanned)
+
+                if spawnpoints:
+                    log.debug("Upserting {} spawnpoints".format(len(spawnpoints)))
+                    bulk_upsert(Spawnpoint, spawnpoints)
+            break
+        except OperationalError as e:
+            # Anything but contention or a lost connection won't go away by
+            # retrying, ingest_loop deals with it
+            if e.args and e.args[0] in MYSQL_LOST_CONNECTION:
+                db.close()
+            elif not (e.args and (e.args[0] in MYSQL_LOCK_ERRORS or
+                                  'is locked' in str(e.args[0]))):
+                raise
+            log.warning("%s... Retrying in %g seconds", e, delay)
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
 
-    bulk_upsert(ScannedLocation, scanned)
+    if pokemons and pokemon_index.enabled:
+        index_pokemon(pokemons)
 
 
 def bulk_upsert(cls, data):
-    num_rows = len(data.values())
+    rows = data.values()
+    num_rows = len(rows)
     i = 0
-    step = 120
+
+    if args.db_type == 'mysql':
+        # Bounded by max_allowed_packet (4MB by default), rows are ~200 bytes
+        step = 1000
+    else:
+        # SQLite allows at most 999 bound variables per statement
+        step = 999 // len(cls._meta.fields)
 
     while i < num_rows:
         log.debug("Inserting items {} to {}".format(i, min(i+step, num_rows)))
+        InsertQuery(cls, rows=rows[i:i+step]).upsert().execute()
+        i += step
+
+
+def index_pokemon(pokemons):
+    for p in pokemons.values():
+        pokemon_index.add(p['encounter_id'], p, p['disappear_time'])
+
+
+def load_pokemon_index():
+    query = (Pokemon
+             .select()
+             .where(Pokemon.disappear_time > datetime.utcnow())
+             .dicts())
+    index_pokemon(dict((p['encounter_id'], p) for p in query))
+    pokemon_index.enabled = True
+    log.info('Loaded {} active pokemon into memory.'.format(
+        len(pokemon_index)))
+
+
+def clean_database_loop(args):
+    while True:
         try:
-            InsertQuery(cls, rows=data.values()[i:min(i+step, num_rows)]).upsert().execute()
-        except OperationalError as e:
-            log.warning("%s... Retrying", e)
-            continue
+            if args.keep_pokemon_hours > 0:
+                cutoff = (datetime.utcnow() -
+                          timedelta(hours=args.keep_pokemon_hours))
+                deleted = bulk_delete(Pokemon, Pokemon.disappear_time < cutoff,
+                                      args.archive_file)
+                log.info('Removed {} expired pokemon.'.format(deleted))
+
+            if args.keep_scanned_hours > 0:
+                cutoff = (datetime.utcnow() -
+                          timedelta(hours=args.keep_scanned_hours))
+                deleted = bulk_delete(ScannedLocation,
+                                      ScannedLocation.last_modified < cutoff)
+                log.info('Removed {} old scanned locations.'.format(deleted))
+        except Exception as e:
+            log.error('Database cleanup error @ {0.__class__.__name__}: {0}'
+                      .format(e))
+
+        time.sleep(config['CLEANUP_INTERVAL'])
+
 
-        i+=step
+def bulk_delete(cls, condition, archive_file=None):
+    # Delete in small transactions so the search threads writing to the
+    # same tables are never locked out for long
+    pk = cls._meta.primary_key
+    deleted = 0
+
+    while True:
+        rows = list(cls.select()
+                       .where(condition)
+                       .limit(config['CLEANUP_BATCH_SIZE'])
+                       .dicts())
+        if not rows:
+            break
+
+        if archive_file:
+            archive_rows(archive_file, rows)
+
+        with db.atomic():
+            cls.delete().where(pk << [r[pk.name] for r in rows]).execute()
+
+        deleted += len(rows)
+        if len(rows) < config['CLEANUP_BATCH_SIZE']:
+            break
+        time.sleep(0.1)
+
+    return deleted
+
+
+def archive_rows(filename, rows):
+    # Every call appends a new gzip member, which gzip readers concatenate
+    with gzip.open(filename, 'ab') as f:
+        for r in rows:
+            f.write(json.dumps(r, default=lambda d: d.isoformat()) + '\n')
 
 
 def create_tables(db):
     db.connect()
-    db.create_tables([Pokemon, Pokestop, Gym, ScannedLocation], safe=True)
+    db.create_tables([Pokemon, Pokestop, Gym, ScannedLocation, Spawnpoint,
+                      RouteLease, ScanNode], safe=True)
+    migrate_tables(db)
     db.close()
+
+
+def migrate_tables(db):
+    # Tables created by older versions are missing columns and indexes that
+    # were added to the models since; add them in place instead of requiring
+    # a fresh db
+    if args.db_type == 'mysql':
+        migrator = MySQLMigrator(db)
+    else:
+        migrator = SqliteMigrator(db)
+
+    operations = []
+    for model in [Pokemon, Pokestop, Gym, ScannedLocation]:
+        table = model._meta.db_table
+        columns = [c.name for c in db.get_columns(table)]
+        for field in model._meta.sorted_fields:
+            if field.db_column not in columns:
+                log.info('Adding column {}.{}'.format(table, field.db_column))
+                operations.append(
+                    migrator.add_column(table, field.db_column, field))
+
+        indexes = [i.columns for i in db.get_indexes(table)]
+        for fields, unique in model._meta.indexes:
+            index_columns = [model._meta.fields[f].db_column for f in fields]
+            if index_columns not in indexes:
+                log.info('Creating index on {} ({}), this may take a while.'
+                         .format(table, ', '.join(index_columns)))
+                operations.append(
+                    migrator.add_index(table, index_columns, unique))
+
+    if operations:
+        migrate(*operations)
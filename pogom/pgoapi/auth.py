@@ -34,6 +34,12 @@ class Auth:
         
         self._login = False
         self._auth_token = None
+        self._token_expire = None
+        self._api_endpoint = None
+        self._token_store = None
+
+        # Seconds to wait for the login servers, per request
+        self._timeout = 30
         
         self._ticket_expire = None
         self._ticket_start = None
@@ -47,6 +53,32 @@ class Auth:
         
     def get_token(self):
         return self._auth_token
+
+    def get_token_expire(self):
+        return self._token_expire
+
+    def set_token(self, token, expire):
+        self._auth_token = token
+        self._token_expire = expire
+        self._login = True
+
+    def get_api_endpoint(self):
+        return self._api_endpoint
+
+    def set_token_store(self, token_store):
+        self._token_store = token_store
+
+    def restore_token(self, username, password):
+        # Reuse the token and API endpoint saved by an earlier login
+        if self._token_store is None:
+            return False
+        saved = self._token_store.load(self._auth_provider, username, password)
+        if not saved:
+            return False
+        self.set_token(saved['token'], saved['expire'])
+        self._api_endpoint = saved['api_endpoint']
+        self.log.info('Reusing saved %s token for: %s', self._auth_provider, username)
+        return True
         
     def has_ticket(self):
         if self._ticket_expire and self._ticket_start and self._ticket_end:
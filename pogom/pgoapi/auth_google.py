@@ -23,6 +23,8 @@ OR OTHER DEALINGS IN THE SOFTWARE.
 Author: tjado <https://github.com/tejado>
 """
 
+from threading import Thread
+
 from auth import Auth
 from gpsoauth import perform_master_login, perform_oauth
 
@@ -38,13 +40,43 @@ class AuthGoogle(Auth):
         
         self._auth_provider = 'google'
 
+    def _call(self, func, *args):
+        # gpsoauth can't be given a timeout, so the call is waited for on
+        # another thread and abandoned after ours, answering like a failed
+        # login. The request itself finishes in the background.
+        result = {}
+
+        def run():
+            try:
+                result['value'] = func(*args)
+            except Exception as e:
+                result['error'] = e
+
+        t = Thread(target=run, name='google_login')
+        t.daemon = True
+        t.start()
+        t.join(self._timeout)
+        if 'error' in result:
+            raise result['error']
+        if 'value' not in result:
+            self.log.error('Google login timed out after %s seconds', self._timeout)
+            return {}
+        return result['value']
+
     def login(self, username, password):
+        if self.restore_token(username, password):
+            return True
+
         self.log.info('Google login for: {}'.format(username))
-        login = perform_master_login(username, password, self.GOOGLE_LOGIN_ANDROID_ID)
-        login = perform_oauth(username, login.get('Token', ''), self.GOOGLE_LOGIN_ANDROID_ID, self.GOOGLE_LOGIN_SERVICE, self.GOOGLE_LOGIN_APP,
+        login = self._call(perform_master_login, username, password, self.GOOGLE_LOGIN_ANDROID_ID)
+        if not login:
+            return False
+        login = self._call(perform_oauth, username, login.get('Token', ''), self.GOOGLE_LOGIN_ANDROID_ID, self.GOOGLE_LOGIN_SERVICE, self.GOOGLE_LOGIN_APP,
             self.GOOGLE_LOGIN_CLIENT_SIG)
             
         self._auth_token = login.get('Auth')
+        if login.get('Expiry'):
+            self._token_expire = int(login.get('Expiry'))
         
         if self._auth_token is None:
             self.log.info('Google Login failed.')
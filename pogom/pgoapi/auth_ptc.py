@@ -25,6 +25,7 @@ Author: tjado <https://github.com/tejado>
 
 import re
 import json
+import time
 import requests
 
 from auth import Auth
@@ -45,10 +46,14 @@ class AuthPtc(Auth):
 
     def login(self, username, password):
 
+        if self.restore_token(username, password):
+            return True
+
         self.log.info('PTC login for: %s', username)
 
         head = {'User-Agent': 'niantic'}
-        r = self._session.get(self.PTC_LOGIN_URL, headers=head)
+        r = self._session.get(self.PTC_LOGIN_URL, headers=head,
+                              timeout=self._timeout)
         
         try:
             jdata = json.loads(r.content)
@@ -63,7 +68,8 @@ class AuthPtc(Auth):
             'username': username,
             'password': password[:15],
         }
-        r1 = self._session.post(self.PTC_LOGIN_URL, data=data, headers=head)
+        r1 = self._session.post(self.PTC_LOGIN_URL, data=data, headers=head,
+                                timeout=self._timeout)
 
         ticket = None
         try:
@@ -83,7 +89,8 @@ class AuthPtc(Auth):
             'code': ticket,
         }
         
-        r2 = self._session.post(self.PTC_LOGIN_OAUTH, data=data1)
+        r2 = self._session.post(self.PTC_LOGIN_OAUTH, data=data1,
+                                timeout=self._timeout)
         access_token = re.sub('&expires.*', '', r2.content)
         access_token = re.sub('.*access_token=', '', access_token)
 
@@ -91,6 +98,9 @@ class AuthPtc(Auth):
             self.log.info('PTC Login successful')
             self.log.debug('PTC Session Token: %s', access_token[:25])
             self._auth_token = access_token
+            expires = re.search('expires=(\d+)', r2.content)
+            if expires:
+                self._token_expire = time.time() + int(expires.group(1))
         else:
             self.log.info('Seems not to be a PTC Session Token... login failed :(')
             return False
@@ -24,6 +24,7 @@ Author: tjado <https://github.com/tejado>
 """
 
 import logging
+import requests
 
 from utilities import f2i
 
@@ -40,7 +41,7 @@ class PGoApi:
 
     API_ENTRY = 'https://pgorelease.nianticlabs.com/plfe/rpc'
 
-    def __init__(self):
+    def __init__(self, session=None, token_store=None):
     
         self.log = logging.getLogger(__name__)
 
@@ -53,8 +54,19 @@ class PGoApi:
 
         self._req_method_list = []
 
+        # One keep-alive connection per account, reused by every RPC call
+        # (and every copy) instead of a new TCP/TLS handshake per request
+        if session is None:
+            session = requests.session()
+            session.headers.update({'User-Agent': 'Niantic App'})
+            session.verify = True
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+            session.mount('https://', adapter)
+        self._session = session
+        self._token_store = token_store
+
     def copy(self):
-        other = PGoApi()
+        other = PGoApi(self._session, self._token_store)
         other.log = self.log
         other._auth_provider = self._auth_provider
         other._api_endpoint = self._api_endpoint
@@ -63,8 +75,12 @@ class PGoApi:
         other._position_alt = self._position_alt
         other._req_method_list = list(self._req_method_list)
         return other
+
+    def close(self):
+        # Drops the keep-alive connection, of this and every copy
+        self._session.close()
         
-    def call(self):
+    def call(self, raw=False):
         if not self._req_method_list:
             return False
         
@@ -74,7 +90,7 @@ class PGoApi:
         
         player_position = self.get_position()
         
-        request = RpcApi(self._auth_provider)
+        request = RpcApi(self._auth_provider, self._session)
         
         if self._api_endpoint:
             api_endpoint = self._api_endpoint
@@ -84,7 +100,7 @@ class PGoApi:
         self.log.info('Execution of RPC')
         response = None
         try:
-            response = request.request(api_endpoint, self._req_method_list, player_position)
+            response = request.request(api_endpoint, self._req_method_list, player_position, raw)
         except ServerBusyOrOfflineException as e:
             self.log.info('Server seems to be busy or offline - try again!')
         
@@ -135,23 +151,33 @@ class PGoApi:
             raise AttributeError
             
         
+    def _new_auth_provider(self, provider):
+        if provider == 'ptc':
+            return AuthPtc()
+        elif provider == 'google':
+            return AuthGoogle()
+        else:
+            raise AuthException("Invalid authentication provider - only ptc/google available.")
+
     def login(self, provider, username, password):
     
         if not isinstance(username, basestring) or not isinstance(password, basestring):
             raise AuthException("Username/password not correctly specified")
         
-        if provider == 'ptc':
-            self._auth_provider = AuthPtc()
-        elif provider == 'google':
-            self._auth_provider = AuthGoogle()
-        else:
-            raise AuthException("Invalid authentication provider - only ptc/google available.")
+        self._auth_provider = self._new_auth_provider(provider)
+        self._auth_provider.set_token_store(self._token_store)
             
         self.log.debug('Auth provider: %s', provider)
         
         if not self._auth_provider.login(username, password):
             self.log.info('Login process failed') 
             return False
+
+        # A token from the store comes with the endpoint it was used on
+        if self._auth_provider.get_api_endpoint():
+            self._api_endpoint = self._auth_provider.get_api_endpoint()
+            self.log.info('Login process completed (saved token)')
+            return True
         
         self.log.info('Starting RPC login sequence (app simulation)')
         
@@ -171,6 +197,12 @@ class PGoApi:
         if 'api_url' in response:
             self._api_endpoint = ('https://{}/rpc'.format(response['api_url']))
             self.log.debug('Setting API endpoint to: %s', self._api_endpoint)
+
+            expire = self._auth_provider.get_token_expire()
+            if self._token_store and expire:
+                self._token_store.save(provider, username, password,
+                                       self._auth_provider.get_token(),
+                                       expire, self._api_endpoint)
         
         elif 'auth_ticket' in response:
             auth_ticket = response['auth_ticket']
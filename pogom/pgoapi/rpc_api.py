@@ -31,22 +31,42 @@ from exceptions import NotLoggedInException, ServerBusyOrOfflineException
 
 from google.protobuf.message import DecodeError
 from protobuf_to_dict import protobuf_to_dict
-from utilities   import h2f, to_camel_case, get_class
+from utilities   import h2f, to_camel_case
 
 import protos.RpcEnum_pb2 as RpcEnum
 import protos.RpcEnvelope_pb2 as RpcEnvelope
+import protos.RpcSub_pb2 as RpcSub
+
+
+def _build_codecs():
+    # RequestMethod value -> (name, proto name, request class, response
+    # class), resolved once here instead of on every request and response
+    codecs = {}
+    for entry_name, entry_id in RpcEnum.RequestMethod.items():
+        proto_name = to_camel_case(entry_name.lower())
+        codecs[entry_id] = (entry_name, proto_name,
+                            getattr(RpcSub, proto_name + 'Request', None),
+                            getattr(RpcSub, proto_name + 'Response', None))
+    return codecs
+
+CODECS = _build_codecs()
 
 class RpcApi:
     
-    def __init__(self, auth_provider):
+    def __init__(self, auth_provider, session=None):
     
         self.log = logging.getLogger(__name__)
     
-        self._session = requests.session()
-        self._session.headers.update({'User-Agent': 'Niantic App'})
-        self._session.verify = True
+        if session is None:
+            session = requests.session()
+            session.headers.update({'User-Agent': 'Niantic App'})
+            session.verify = True
+        self._session = session
         
         self._auth_provider = auth_provider
+
+        # Seconds to wait for the RPC servers
+        self._timeout = 30
     
     def get_rpc_id(self):
         return 8145806132888207460
@@ -66,13 +86,14 @@ class RpcApi:
         
         request_proto_serialized = request_proto_plain.SerializeToString()
         try:
-            http_response = self._session.post(endpoint, data=request_proto_serialized)
-        except requests.exceptions.ConnectionError as e:
+            http_response = self._session.post(endpoint, data=request_proto_serialized,
+                                               timeout=self._timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
             raise ServerBusyOrOfflineException
         
         return http_response
     
-    def request(self, endpoint, subrequests, player_position):
+    def request(self, endpoint, subrequests, player_position, raw=False):
     
         if not self._auth_provider or self._auth_provider.is_login() is False:
             raise NotLoggedInException()
@@ -80,7 +101,7 @@ class RpcApi:
         request_proto = self._build_main_request(subrequests, player_position)
         response = self._make_rpc(endpoint, request_proto)
         
-        response_dict = self._parse_main_request(response, subrequests)
+        response_dict = self._parse_main_request(response, subrequests, raw)
         
         return response_dict
     
@@ -120,11 +141,11 @@ class RpcApi:
                 entry_id = entry.items()[0][0]
                 entry_content = entry[entry_id]
 
-                entry_name = RpcEnum.RequestMethod.Name(entry_id)
-                
-                proto_name = to_camel_case(entry_name.lower()) + 'Request'
-                proto_classname = 'pogom.pgoapi.protos.RpcSub_pb2.' + proto_name
-                subrequest_extension = get_class(proto_classname)()
+                entry_name, proto_name, request_class, _ = CODECS[entry_id]
+                proto_name += 'Request'
+                if request_class is None:
+                    raise Exception('Protobuf definition for {} not found'.format(proto_name))
+                subrequest_extension = request_class()
 
                 for (key, value) in entry_content.items():
                     # if isinstance(value, list):
@@ -150,7 +171,7 @@ class RpcApi:
         return mainrequest
         
     
-    def _parse_main_request(self, response_raw, subrequests):
+    def _parse_main_request(self, response_raw, subrequests, raw=False):
         self.log.debug('Parsing main RPC response...')
         
         if response_raw.status_code != 200:
@@ -171,12 +192,17 @@ class RpcApi:
         
         self.log.debug('Protobuf structure of rpc response:\n\r%s', response_proto)
        
-        response_proto_dict = protobuf_to_dict(response_proto)
-        response_proto_dict = self._parse_sub_responses(response_proto, subrequests, response_proto_dict)
+        # Raw requests skip the generic dict conversion: the envelope is left
+        # out and every sub response is returned as its protobuf message
+        if raw:
+            response_proto_dict = {}
+        else:
+            response_proto_dict = protobuf_to_dict(response_proto)
+        response_proto_dict = self._parse_sub_responses(response_proto, subrequests, response_proto_dict, raw)
         
         return response_proto_dict
     
-    def _parse_sub_responses(self, response_proto, subrequests_list, response_proto_dict):
+    def _parse_sub_responses(self, response_proto, subrequests_list, response_proto_dict, raw=False):
         self.log.debug('Parsing sub RPC responses...')
         response_proto_dict['responses'] = {}
 
@@ -194,14 +220,13 @@ class RpcApi:
             else:
                 entry_id =  request_entry.items()[0][0]
                 
-            entry_name = RpcEnum.RequestMethod.Name(entry_id)
-            proto_name = to_camel_case(entry_name.lower()) + 'Response'
-            proto_classname = 'pogom.pgoapi.protos.RpcSub_pb2.' + proto_name
+            entry_name, proto_name, _, response_class = CODECS[entry_id]
+            proto_classname = 'pogom.pgoapi.protos.RpcSub_pb2.' + proto_name + 'Response'
             
             subresponse_return = None
-            try:
-                subresponse_extension = get_class(proto_classname)()            
-            except Exception as e:
+            if response_class is not None:
+                subresponse_extension = response_class()
+            else:
                 subresponse_extension = None
                 error = 'Protobuf definition for {} not found'.format(proto_classname)
                 subresponse_return = error
@@ -210,13 +235,18 @@ class RpcApi:
             if subresponse_extension:
                 try: 
                     subresponse_extension.ParseFromString(subresponse)
-                    subresponse_return = protobuf_to_dict(subresponse_extension)
+                    if raw:
+                        subresponse_return = subresponse_extension
+                    else:
+                        subresponse_return = protobuf_to_dict(subresponse_extension)
                 except:
                     error = "Protobuf definition for {} seems not to match".format(proto_classname)
                     subresponse_return = error
                     self.log.debug(error)
             
-            response_proto_dict['responses'][entry_name] = subresponse_return
+            # Raw responses only contain what could actually be decoded
+            if not raw or not isinstance(subresponse_return, basestring):
+                response_proto_dict['responses'][entry_name] = subresponse_return
             i += 1
            
         return response_proto_dict
@@ -0,0 +1,117 @@
+"""
+Encrypted file store for auth tokens, so a restart can skip the login of
+every account whose token is still valid.
+
+Each entry is keyed by a hash of provider and username, and encrypted with
+a key derived from the account's password: HMAC-SHA256 in counter mode as
+keystream, then HMAC-SHA256 over salt, nonce and ciphertext.
+"""
+
+import os
+import json
+import time
+import hmac
+import base64
+import struct
+import hashlib
+import logging
+
+from threading import Lock
+
+log = logging.getLogger(__name__)
+
+KDF_ITERATIONS = 10000
+
+
+def _keys(password, salt):
+    master = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt,
+                                 KDF_ITERATIONS)
+    return (hmac.new(master, 'encrypt', hashlib.sha256).digest(),
+            hmac.new(master, 'authenticate', hashlib.sha256).digest())
+
+
+def _keystream(key, nonce, length):
+    blocks = [hmac.new(key, nonce + struct.pack('>Q', i), hashlib.sha256).digest()
+              for i in range((length + 31) // 32)]
+    return ''.join(blocks)[:length]
+
+
+def _xor(data, stream):
+    return ''.join(chr(ord(a) ^ ord(b)) for a, b in zip(data, stream))
+
+
+def encrypt(password, plaintext):
+    salt, nonce = os.urandom(16), os.urandom(16)
+    enc_key, mac_key = _keys(password, salt)
+    ciphertext = _xor(plaintext, _keystream(enc_key, nonce, len(plaintext)))
+    tag = hmac.new(mac_key, salt + nonce + ciphertext, hashlib.sha256).digest()
+    return base64.b64encode(salt + nonce + ciphertext + tag)
+
+
+def decrypt(password, blob):
+    # Returns None if the password is wrong or the entry was tampered with
+    data = base64.b64decode(blob)
+    salt, nonce, ciphertext, tag = data[:16], data[16:32], data[32:-32], data[-32:]
+    enc_key, mac_key = _keys(password, salt)
+    expected = hmac.new(mac_key, salt + nonce + ciphertext, hashlib.sha256).digest()
+    if not hmac.compare_digest(tag, expected):
+        return None
+    return _xor(ciphertext, _keystream(enc_key, nonce, len(ciphertext)))
+
+
+class TokenStore:
+
+    def __init__(self, filename, min_lifetime=0):
+        self.filename = filename
+        self.min_lifetime = min_lifetime
+
+        self._lock = Lock()
+        self._entries = {}
+
+        if os.path.exists(filename):
+            try:
+                with open(filename) as f:
+                    self._entries = json.load(f)
+            except ValueError as e:
+                log.warning('Ignoring unreadable token store %s: %s', filename, e)
+
+    def _key(self, provider, username):
+        return hashlib.sha256('{}:{}'.format(provider, username.encode('utf-8'))).hexdigest()
+
+    def load(self, provider, username, password):
+        # Token, expiry and API endpoint of the last login, if the token is
+        # still valid for at least min_lifetime seconds
+        with self._lock:
+            blob = self._entries.get(self._key(provider, username))
+        if blob is None:
+            return None
+
+        plaintext = decrypt(password, blob)
+        if plaintext is None:
+            log.info('Saved token of %s does not match its password', username)
+            return None
+
+        saved = json.loads(plaintext)
+        if saved['expire'] - self.min_lifetime <= time.time():
+            return None
+        return saved
+
+    def save(self, provider, username, password, token, expire, api_endpoint):
+        blob = encrypt(password, json.dumps({'token': token,
+                                             'expire': expire,
+                                             'api_endpoint': api_endpoint}))
+        with self._lock:
+            self._entries[self._key(provider, username)] = blob
+            self._write()
+
+    def delete(self, provider, username):
+        with self._lock:
+            if self._entries.pop(self._key(provider, username), None) is not None:
+                self._write()
+
+    def _write(self):
+        tmp = self.filename + '.tmp'
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self._entries, f)
+        os.rename(tmp, self.filename)
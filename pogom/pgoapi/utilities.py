@@ -26,8 +26,10 @@ Author: tjado <https://github.com/tejado>
 import struct
 import re
 
+from collections import OrderedDict
+from threading import Lock
 from importlib import import_module
-from s2sphere import CellId, LatLng
+from s2sphere import CellId, LatLng, xyz_to_face_uv
 from google.protobuf.internal import encoder
 from geopy.geocoders import GoogleV3
 
@@ -69,8 +71,52 @@ def get_class(cls):
     class_ = getattr(import_module(module_), class_)
     return class_
     
+# Routes are walked over and over again, so the encoded walk around each
+# level 15 cell is kept in a small LRU cache shared by all search threads
+CELL_WALK_CACHE_SIZE = 4096
+
+_cell_walk_cache = OrderedDict()
+_cell_walk_lock = Lock()
+cell_walk_stats = {'hits': 0, 'misses': 0}
+
 def get_cellid(lat, long):
-    origin = CellId.from_lat_lng(LatLng.from_degrees(lat, long)).parent(15)
+    # A level 15 cell is identified by its face and the top 15 bits of the
+    # leaf cell i/j coordinates, which are cheap to compute; building the
+    # CellId itself (CellId.from_face_ij) only happens on a cache miss
+    face, u, v = xyz_to_face_uv(LatLng.from_degrees(lat, long).to_point())
+    i = CellId.st_to_ij(CellId.uv_to_st(u))
+    j = CellId.st_to_ij(CellId.uv_to_st(v))
+    shift = CellId.MAX_LEVEL - 15
+    key = (face, i >> shift, j >> shift)
+
+    with _cell_walk_lock:
+        walk = _cell_walk_cache.pop(key, None)
+        if walk is not None:
+            _cell_walk_cache[key] = walk
+            cell_walk_stats['hits'] += 1
+            return walk
+
+    walk = get_cell_walk(CellId.from_face_ij(face, i, j).parent(15))
+
+    with _cell_walk_lock:
+        _cell_walk_cache[key] = walk
+        cell_walk_stats['misses'] += 1
+        if len(_cell_walk_cache) > CELL_WALK_CACHE_SIZE:
+            _cell_walk_cache.popitem(last=False)
+
+    return walk
+
+def cell_walk_hit_rate():
+    # Share of get_cellid calls answered from the cache since the last call,
+    # None if there were none
+    with _cell_walk_lock:
+        hits, misses = cell_walk_stats['hits'], cell_walk_stats['misses']
+        cell_walk_stats['hits'] = cell_walk_stats['misses'] = 0
+    if not hits + misses:
+        return None
+    return float(hits) / (hits + misses)
+
+def get_cell_walk(origin):
     walk = [origin.id()]
 
     # 10 before and 10 after
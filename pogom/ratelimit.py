@@ -0,0 +1,134 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Request pacing for the search engines.
+
+Every request takes a token from its account's bucket and from the bucket
+of the API endpoint it goes to. Both rates adapt AIMD style: every success
+adds RATE_INCREASE requests/s up to the bucket's maximum (for accounts
+--max-scan-rate, or one request per --scan-delay if that is faster),
+failed or empty responses multiply the rate by RATE_DECREASE down to one
+request per REQ_HEAVY_SLEEP seconds. An account slows down on every failure. An
+endpoint only does once REQ_MAX_FAILED failures, and at least
+RATE_FAILED_RATIO of its responses, failed within RATE_WINDOW seconds: the
+occasional failure of accounts probing their own limit is expected and
+shouldn't throttle all of them.
+'''
+
+import logging
+import time
+
+from threading import Lock
+
+from . import config
+
+log = logging.getLogger(__name__)
+
+
+class TokenBucket(object):
+
+    def __init__(self, name, rate, max_rate, burst=1, max_failed=1,
+                 failed_ratio=0):
+        self.name = name
+        self.rate = rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.max_failed = max_failed
+        self.failed_ratio = failed_ratio
+
+        self._lock = Lock()
+        self._tokens = burst
+        self._updated = time.time()
+        self._window = 0
+        self._ok = 0
+        self._failed = 0
+
+    def _count(self, now):
+        if now - self._window > config['RATE_WINDOW']:
+            self._window = now
+            self._ok = 0
+            self._failed = 0
+
+    def reserve(self):
+        # Takes a token, returns how long to wait before using it. Tokens
+        # are handed out in advance, so concurrent callers queue up instead
+        # of all waking at once.
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0, -self._tokens / self.rate)
+
+    def success(self):
+        with self._lock:
+            self._count(time.time())
+            self._ok += 1
+            self.rate = min(self.max_rate, self.rate + config['RATE_INCREASE'])
+
+    def failure(self):
+        with self._lock:
+            now = time.time()
+            self._count(now)
+            self._failed += 1
+            if (self._failed < self.max_failed or self._failed <
+                    self.failed_ratio * (self._ok + self._failed)):
+                return
+            # Start counting afresh at the new rate
+            self._window = now
+            self._ok = 0
+            self._failed = 0
+
+            self.rate = max(1.0 / config['REQ_HEAVY_SLEEP'],
+                            self.rate * config['RATE_DECREASE'])
+            rate = self.rate
+        log.debug('Slowed {} down to {:.3f} requests/s'.format(self.name, rate))
+
+
+class RateLimiter(object):
+
+    def __init__(self):
+        self._lock = Lock()
+        self._accounts = {}
+        self._endpoints = {}
+
+    def _bucket(self, buckets, key, *args):
+        with self._lock:
+            if key not in buckets:
+                buckets[key] = TokenBucket(*args)
+            return buckets[key]
+
+    def buckets(self, userid, endpoint):
+        # Accounts start out at one request per --scan-delay, and may speed
+        # up to --max-scan-rate, but never stay below their starting rate
+        max_rate = rate = config['RATE_ACCOUNT_MAX']
+        if config['REQ_SLEEP'] > 0:
+            rate = 1.0 / config['REQ_SLEEP']
+            max_rate = max(max_rate, rate)
+        account = self._bucket(self._accounts, userid,
+                               'account {}'.format(userid), rate,
+                               max_rate, 1, 1)
+        endpoint = self._bucket(self._endpoints, endpoint,
+                                'endpoint {}'.format(endpoint),
+                                config['RATE_ENDPOINT'],
+                                config['RATE_ENDPOINT_MAX'],
+                                config['RATE_ENDPOINT'],
+                                config['REQ_MAX_FAILED'],
+                                config['RATE_FAILED_RATIO'])
+        return account, endpoint
+
+    def reserve(self, userid, endpoint):
+        return max(bucket.reserve() for bucket in self.buckets(userid, endpoint))
+
+    def success(self, userid, endpoint):
+        for bucket in self.buckets(userid, endpoint):
+            bucket.success()
+
+    def failure(self, userid, endpoint):
+        for bucket in self.buckets(userid, endpoint):
+            bucket.failure()
+
+
+limiter = RateLimiter()
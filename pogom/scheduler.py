@@ -0,0 +1,130 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from collections import deque
+from threading import Condition
+
+from . import config
+from .pgoapi.utilities import cell_walk_hit_rate
+
+log = logging.getLogger(__name__)
+
+
+class Batch(object):
+
+    def __init__(self, loop, waypoints, prune=False, deadline=None):
+        self.loop = loop
+        self.waypoints = waypoints
+        # Whether waypoints other accounts just covered may be skipped, and
+        # how many were
+        self.prune = prune
+        self.skipped = 0
+        # Time after which the batch isn't worth walking any more
+        self.deadline = deadline
+        self.expired = False
+
+
+class WorkStealingScheduler(object):
+    '''
+    Hands out the waypoints of a search loop in batches of SCHEDULER_BATCH_SIZE.
+
+    Every route is split into batches on one worker's deque, routes spread
+    round robin over the workers. A worker takes batches from the front of
+    its own deque, and once that is empty steals from the back of the
+    longest deque, so nobody idles while another route is still pending.
+
+    A loop is only waited for until all its batches are handed out, then
+    the next one can be queued while the last batches are still walked.
+
+    Workers count the waypoints of a pruned loop they skipped on the batch,
+    the loop's log line reports them once all its batches are done.
+
+    Batches of a loop with a deadline that are still queued once it passed
+    are dropped instead of handed out, so a backlog doesn't keep workers
+    visiting places for nothing.
+    '''
+
+    def __init__(self, num_workers):
+        self._cond = Condition()
+        self._deques = [deque() for _ in range(num_workers)]
+        self._loops = {}
+        self.completed = 0
+
+    def put_loop(self, loop, routes, prune=False, deadline=None):
+        with self._cond:
+            stats = {'start': None, 'batches': 0, 'waypoints': 0, 'stolen': 0,
+                     'skipped': 0, 'expired': 0}
+            for i, route in enumerate(routes):
+                worker_deque = self._deques[i % len(self._deques)]
+                size = config['SCHEDULER_BATCH_SIZE']
+                for start in range(0, len(route), size):
+                    worker_deque.append(Batch(loop, route[start:start + size],
+                                              prune, deadline))
+                    stats['batches'] += 1
+                stats['waypoints'] += len(route)
+
+            if stats['batches']:
+                self._loops[loop] = stats
+                self._cond.notify_all()
+
+    def wait_dispatched(self):
+        # Blocks until every queued batch has been taken by a worker
+        with self._cond:
+            while any(self._deques):
+                self._cond.wait()
+
+    def get(self, worker, block=True):
+        with self._cond:
+            while True:
+                if self._deques[worker]:
+                    batch = self._deques[worker].popleft()
+                    stolen = False
+                else:
+                    victim = max(self._deques, key=len)
+                    if not victim:
+                        if not block:
+                            return None
+                        self._cond.wait()
+                        continue
+                    batch = victim.pop()
+                    stolen = True
+
+                stats = self._loops[batch.loop]
+                if stats['start'] is None:
+                    stats['start'] = time.time()
+                if batch.deadline is None or batch.deadline > time.time():
+                    break
+                batch.expired = True
+                self.task_done(batch)
+                if not any(self._deques):
+                    self._cond.notify_all()
+
+            if stolen:
+                stats['stolen'] += 1
+            if not any(self._deques):
+                self._cond.notify_all()
+            return batch
+
+    def task_done(self, batch):
+        with self._cond:
+            stats = self._loops[batch.loop]
+            if batch.expired:
+                stats['expired'] += len(batch.waypoints)
+            else:
+                self.completed += len(batch.waypoints) - batch.skipped
+            stats['skipped'] += batch.skipped
+            stats['batches'] -= 1
+            if stats['batches']:
+                return
+            del self._loops[batch.loop]
+
+        hit_rate = cell_walk_hit_rate()
+        log.info('Search loop {} complete: {} waypoints in {:.1f} seconds, '
+                 '{} batches stolen, {} redundant requests skipped, {} expired, '
+                 'cell walk cache hit rate {}.'.format(
+                     batch.loop, stats['waypoints'], time.time() - stats['start'],
+                     stats['stolen'], stats['skipped'], stats['expired'],
+                     'n/a' if hit_rate is None else '{:.1%}'.format(hit_rate)))
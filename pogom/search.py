@@ -3,39 +3,52 @@
 
 '''
 Search Architecture:
- - Create a Queue
-   - Holds a list of locations to scan
+ - Create a work stealing scheduler
+   - Holds the waypoints to scan, in batches per route
  - Create N search threads
-   - Each search thread will be responsible for hitting the API for a given scan location
+   - Each search thread will be responsible for hitting the API for the waypoints of a batch
  - Create a "overseer" loop
-   - Creates/updates the search grid, populates the Queue, and waits for the current search itteration to complete
+   - Creates/updates the routes, queues them on the scheduler, and waits until the current search itteration is handed out
+   - With --spawn-scan, queues the locations of the spawn points that are due instead, every SPAWN_TICK seconds
+ - Every scan goes into a spatial index of recent scans, together with those other processes wrote to the db
+   - Search threads skip route waypoints another account scanned within --coverage-window seconds
    -
 '''
 
 import logging
 import time
 import math
+import heapq
 import threading
 import random
-import maps
 import json
+import calendar
+import zlib
 
 
-from threading import Thread, Lock
-from queue import Queue
+from threading import Thread, Condition
+from datetime import datetime, timedelta
 
-from pgoapi import PGoApi
 from pgoapi.utilities import f2i, get_cellid
 
-from . import config
-from .models import parse_map
+from . import config, accounts, coordinator
+from .models import parse_map, Spawnpoint, ScannedLocation
+from .ingest import ingest_queue
+from .waypoints import get_route_waypoints
+from .scheduler import WorkStealingScheduler
+from .ratelimit import limiter
+from .spatial import GridIndex, EARTH_RADIUS, distance, circle_overlap
 
 log = logging.getLogger(__name__)
 
 TIMESTAMP = '\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000\000'
 
 
-search_queue = Queue()
+scheduler = None
+
+# Recent scans of every account, see covered()
+scan_index = GridIndex()
+scans_loaded = None
 
 
 def calculate_lng_degrees(lat):
@@ -51,7 +64,7 @@ def send_map_request(api, position):
                                  longitude=f2i(position[1]),
                                  since_timestamp_ms=TIMESTAMP,
                                  cell_id=get_cellid(position[0], position[1]))
-        return api_copy.call()
+        return api_copy.call(raw=True)
     except Exception as e:
         log.warning("Uncaught exception when downloading map " + str(e))
         return False
@@ -78,24 +91,18 @@ def get_new_coords(init_loc, distance, bearing):
 
 def generate_location_steps(route):
     time.sleep(1)
-    homedest = maps.coordinates(route[0])
-    waydest = maps.coordinates(route[1])
-    loopdest = maps.coordinates(route[2])
-    
-    yield maps.getElevation(homedest)
     speed=11+random.choice([-3,-2,-1,0,1,2])
-    mpath = maps.path(homedest, waydest, speed=speed)
-    for s in mpath:
-        yield (randomizeCoords((s[0],s[1],s[2])))
-    
-    mpath = maps.path(waydest, loopdest, speed=speed)
-    for s in mpath:
-        yield (randomizeCoords((s[0],s[1],s[2])))
-        
-    mpath = maps.path(loopdest, homedest, speed=speed)
-    for s in mpath:
+    waypoints = get_route_waypoints(route, speed)
+
+    yield waypoints[0]
+    for s in waypoints[1:]:
         yield (randomizeCoords((s[0],s[1],s[2])))
 
+def precompiled_location_steps(route):
+    # Routes loaded from a compile_routes.py waypoint file
+    for s in route:
+        yield (randomizeCoords(s))
+
 def randomizeCoords(coords):
     lat = coords[0]
     lon = coords[1]
@@ -104,94 +111,243 @@ def randomizeCoords(coords):
     lon = lon + (random.uniform(0.00000001,0.0000013) * random.choice([-1,1]))
     return(lat,lon,z)
     
-def login(api, args, position, i=0):
-    log.info('Attempting login to Pokemon Go.')
-
-    api.set_position(*position)
-    print args.pgousers[i][0], args.pgousers[i][1]
-    while not api.login(args.auth_service, args.pgousers[i][0], args.pgousers[i][1]):
-        log.info('Failed to login to Pokemon Go. Trying again in {:g} seconds.'.format(args.login_delay))
-        time.sleep(args.login_delay)
-
-    log.info('Login to Pokemon Go successful.')
-
-
 #
 # Search Threads Logic
 #
 def create_search_threads(args):
+    global scheduler
     search_threads = []
     num=len(args.pgousers)
+    scheduler = WorkStealingScheduler(num)
     for i in range(num):
-        t = Thread(target=search_thread, name='search_thread-{}'.format(i), args=(i,args,search_queue,))
+        t = Thread(target=search_thread, name='search_thread-{}'.format(i), args=(i,args,scheduler,))
         t.daemon = True
         t.start()
         search_threads.append(t)
+    return scheduler
 
 
-def search_thread(userid,args,q):
-    api = PGoApi()
+def search_thread(userid,args,scheduler):
     step =1
     threadname = threading.currentThread().getName()
     log.debug("Search thread {}: started and waiting".format(threadname))
     while True:
 
-        # Get the next item off the queue (this blocks till there is something)
-        route, lock = q.get()
-        i=0
-        for loc in route:
-            i=i+1
-            if api._auth_provider and api._auth_provider._ticket_expire:
-                remaining_time = api._auth_provider._ticket_expire/1000 - time.time()
-        
-                if remaining_time > 60:
-                    log.info("Skipping Pokemon Go login process since already logged in \
-                        for another {:.2f} seconds".format(remaining_time))
-                else:
-                    login(api, args, loc[1], userid)
-            else:
-                login(api, args, loc[1], userid)
+        # Get the next batch of our own or, if there is none, another
+        # worker's route (this blocks till there is something)
+        batch = scheduler.get(userid)
+        for loc in batch.waypoints:
+            if batch.prune and covered(userid, loc[1]):
+                batch.skipped += 1
+                continue
+            i=loc[0]+1
             response_dict = {}
             failed_consecutive = 0
             while not response_dict:
+                # Logins happen on the account pool's thread, this is the
+                # account's current session
+                api = accounts.account_pool.get(userid)
+                endpoint = api._api_endpoint
+                time.sleep(limiter.reserve(userid, endpoint))
+                record_scan(userid, loc[1])
                 response_dict = send_map_request(api, loc[1])
                 print '{}: location: {}'.format(args.pgousers[userid][0], loc[1])
                 if response_dict:
-                    with lock:
-                        try:
-                            parse_map(response_dict, i, step, loc[1])
-                            log.debug("{}: itteration {} step {} complete".format(threadname, i, step))
-                        except KeyError:
-                            log.error('Search thread failed. Response dictionary key error')
-                            log.debug('{}: itteration {} step {} failed. Response dictionary\
-                                key error.'.format(threadname, i, step))
-                            failed_consecutive += 1
-                            if(failed_consecutive >= config['REQ_MAX_FAILED']):
-                                log.error('Niantic servers under heavy load. Waiting before trying again')
-                                time.sleep(config['REQ_HEAVY_SLEEP'])
-                                failed_consecutive = 0
-                            response_dict = {}
+                    try:
+                        ingest_queue.put(parse_map(response_dict, i, step, loc[1]))
+                        limiter.success(userid, endpoint)
+                        log.debug("{}: itteration {} step {} complete".format(threadname, i, step))
+                    except KeyError:
+                        log.error('Search thread failed. Response dictionary key error')
+                        log.debug('{}: itteration {} step {} failed. Response dictionary\
+                            key error.'.format(threadname, i, step))
+                        limiter.failure(userid, endpoint)
+                        failed_consecutive += 1
+                        if(failed_consecutive >= config['REQ_MAX_FAILED']):
+                            log.error('Niantic servers under heavy load. Slowing down before trying again')
+                            accounts.account_pool.invalidate(userid)
+                            failed_consecutive = 0
+                        response_dict = {}
                 else:
-                    log.info('Map download failed, waiting and retrying')
+                    log.info('Map download failed, slowing down and retrying')
                     log.debug('{}: itteration {} step {} failed'.format(threadname, i, step))
-                    print "sleeping {}".format(config['REQ_SLEEP'])
-                    time.sleep(config['REQ_SLEEP'])
-    
-            print "sleeping {}".format(config['REQ_SLEEP'])
-            time.sleep(config['REQ_SLEEP'])
-        q.task_done()
+                    limiter.failure(userid, endpoint)
+                    failed_consecutive += 1
+                    if(failed_consecutive >= config['REQ_MAX_FAILED']):
+                        accounts.account_pool.invalidate(userid)
+                        failed_consecutive = 0
+        scheduler.task_done(batch)
+
+
+#
+# Pooled engine: a few threads take turns driving every account
+#
+def create_pooled_threads(args):
+    global scheduler
+    num=len(args.pgousers)
+    scheduler = WorkStealingScheduler(num)
+
+    # (due time, account) for every account that is not being stepped
+    # right now, an account's state is only touched by the thread stepping it
+    timers = [(0, userid) for userid in range(num)]
+    states = [{'batch': None, 'index': 0, 'failed': 0, 'reserved': False}
+              for _ in range(num)]
+    cond = Condition()
+
+    for i in range(args.engine_threads):
+        t = Thread(target=pooled_thread, name='pooled_thread-{}'.format(i),
+                   args=(args, scheduler, timers, states, cond))
+        t.daemon = True
+        t.start()
+    return scheduler
+
+
+def pooled_thread(args, scheduler, timers, states, cond):
+    while True:
+        with cond:
+            while True:
+                if timers and timers[0][0] <= time.time():
+                    userid = heapq.heappop(timers)[1]
+                    break
+                cond.wait(timers[0][0] - time.time() if timers else None)
+
+        delay = pooled_step(args, scheduler, userid, states[userid])
+
+        with cond:
+            heapq.heappush(timers, (time.time() + delay, userid))
+            cond.notify()
+
+
+def pooled_step(args, scheduler, userid, state):
+    # One request for one account, returns how long until its next one
+    api = accounts.account_pool.get(userid, block=False)
+    if api is None:
+        return 1
+
+    if state['batch'] is None:
+        state['batch'] = scheduler.get(userid, block=False)
+        state['index'] = 0
+        if state['batch'] is None:
+            return 1
+
+    loc = state['batch'].waypoints[state['index']]
+    if state['batch'].prune and covered(userid, loc[1]):
+        state['batch'].skipped += 1
+        return pooled_next(scheduler, state)
+
+    # Take a slot from the rate limiter first, and come back for the
+    # request once it is due
+    endpoint = api._api_endpoint
+    if not state['reserved']:
+        state['reserved'] = True
+        wait = limiter.reserve(userid, endpoint)
+        if wait > 0:
+            return wait
+    state['reserved'] = False
+
+    record_scan(userid, loc[1])
+    response_dict = send_map_request(api, loc[1])
+    if not response_dict:
+        log.info('Map download failed, slowing down and retrying')
+        limiter.failure(userid, endpoint)
+        state['failed'] += 1
+        if state['failed'] >= config['REQ_MAX_FAILED']:
+            accounts.account_pool.invalidate(userid)
+            state['failed'] = 0
+        return 0
+
+    try:
+        ingest_queue.put(parse_map(response_dict, loc[0] + 1, 1, loc[1]))
+    except KeyError:
+        log.error('Search thread failed. Response dictionary key error')
+        limiter.failure(userid, endpoint)
+        state['failed'] += 1
+        if state['failed'] >= config['REQ_MAX_FAILED']:
+            log.error('Niantic servers under heavy load. Slowing down before trying again')
+            accounts.account_pool.invalidate(userid)
+            state['failed'] = 0
+        return 0
+
+    limiter.success(userid, endpoint)
+    state['failed'] = 0
+    return pooled_next(scheduler, state)
+
+
+def pooled_next(scheduler, state):
+    state['index'] += 1
+    if state['index'] == len(state['batch'].waypoints):
+        scheduler.task_done(state['batch'])
+        state['batch'] = None
+    return 0
+
+
+#
+# Coverage of recent scans
+#
+def record_scan(userid, position):
+    # Called as the request goes out, so accounts walking the same streets
+    # at the same time don't all scan them. A failed request is retried by
+    # the same account, which its own entry doesn't stop.
+    if config['COVERAGE_WINDOW'] <= 0:
+        return
+    # Keyed like the scan's ScannedLocation row
+    scan_index.add(str(position[0]) + ',' + str(position[1]),
+                   {'latitude': position[0], 'longitude': position[1],
+                    'userid': userid},
+                   time.time() + config['COVERAGE_WINDOW'])
+
+
+def load_recent_scans():
+    # Scans of other shards and nodes only reach us through the db. Our own
+    # rows come back too, but are already indexed with their account.
+    global scans_loaded
+    now = datetime.utcnow()
+    since = now - timedelta(seconds=config['COVERAGE_WINDOW'])
+    if scans_loaded is not None:
+        since = max(since, scans_loaded - timedelta(seconds=config['SYNC_OVERLAP']))
+
+    for s in ScannedLocation.get_recent(-90, -180, 90, 180, since):
+        if s['scanned_id'] in scan_index:
+            continue
+        scan_index.add(s['scanned_id'],
+                       {'latitude': s['latitude'], 'longitude': s['longitude'],
+                        'userid': None},
+                       calendar.timegm(s['last_modified'].timetuple()) +
+                       config['COVERAGE_WINDOW'])
+    scans_loaded = now
+
+
+def covered(userid, position):
+    # Whether another account's recent scan covered at least COVERAGE_RATIO
+    # of the area a scan from here would
+    lat, lng = position[0], position[1]
+    radius = config['SCAN_RADIUS']
+    lat_gap = math.degrees(2.0 * radius / EARTH_RADIUS)
+    lng_gap = lat_gap / math.cos(math.radians(lat))
+
+    for s in scan_index.query(lat - lat_gap, lng - lng_gap,
+                              lat + lat_gap, lng + lng_gap, time.time()):
+        if s['userid'] == userid:
+            continue
+        d = distance(lat, lng, s['latitude'], s['longitude'])
+        if circle_overlap(d, radius) >= config['COVERAGE_RATIO']:
+            return True
+    return False
 
 
 #
 # Search Overseer
 #
 def search_loop(args):
+    if args.spawn_scan:
+        return spawn_loop(args)
+
     i = 0
     while True:
         log.info("Search loop {} starting".format(i))
         try:
-            search(args)
-            log.info("Search loop {} complete.".format(i))
+            search(args, i)
+            log.info("Search loop {} queued.".format(i))
             i += 1
         except Exception as e:
             log.error('Scanning error @ {0.__class__.__name__}: {0}'.format(e))
@@ -204,24 +360,107 @@ def search_loop(args):
 #
 # Overseer main logic
 #
-def search(args):
+def search(args, loop):
+
+    # With --coordinate only the routes leased to this node are scanned
+    route_ids = range(len(args.routes))
+    if coordinator.coordinator:
+        route_ids = coordinator.coordinator.routes()
+        if not route_ids:
+            log.info('No routes leased to this node, waiting.')
+            time.sleep(config['LEASE_HEARTBEAT'])
+            return
+
+    routes = []
+    for r in [args.routes[i] for i in route_ids]:
+        if args.waypoints:
+            waypoints = list(enumerate(precompiled_location_steps(r)))
+        else:
+            waypoints = list(enumerate(generate_location_steps(r)))
+        routes.append(waypoints)
+
+    prune = config['COVERAGE_WINDOW'] > 0
+    if prune:
+        load_recent_scans()
+    scheduler.put_loop(loop, routes, prune)
+
+    # Wait until every batch of this itteration is handed out (not
+    # nessearily done), the next itteration then overlaps its tail
+    scheduler.wait_dispatched()
+
+
+#
+# Spawn-timed overseer
+#
+def spawn_loop(args):
+    loop = 0
+    spawnpoints = []
+    loaded = 0
+    last_tick = time.time()
+    while True:
+        try:
+            if time.time() - loaded > config['SPAWN_RELOAD']:
+                spawnpoints = Spawnpoint.get_spawnpoints()
+                loaded = time.time()
+                log.info('Scheduling scans for {} spawn points.'.format(len(spawnpoints)))
+
+            # Walking the routes is how spawn points get learned
+            if not spawnpoints:
+                log.info('No spawn points learned yet, walking the routes.')
+                search(args, loop)
+                loop += 1
+                last_tick = time.time()
+                continue
+
+            now = time.time()
+            due = [s for s in spawn_share(args, spawnpoints)
+                   if spawn_due(s['spawn_second'] + config['SPAWN_DELAY'],
+                                last_tick, now)]
+            # The earliest of these Pokemon is gone SPAWN_DURATION after it
+            # spawned, scans queued up past that would find nothing
+            deadline = last_tick - config['SPAWN_DELAY'] + config['SPAWN_DURATION']
+            last_tick = now
+            if due:
+                routes = spawn_routes(due, len(args.pgousers))
+                log.debug('{} spawn points due, {} scans queued.'.format(
+                    len(due), sum(len(r) for r in routes)))
+                scheduler.put_loop(loop, routes, deadline=deadline)
+                loop += 1
+        except Exception as e:
+            log.error('Scanning error @ {0.__class__.__name__}: {0}'.format(e))
+
+        time.sleep(config['SPAWN_TICK'])
+
+
+def spawn_due(second, start, end):
+    # Whether the second of the hour passed in the (start, end] window
+    return 0 < (second - start) % 3600 <= end - start
+
+
+def spawn_share(args, spawnpoints):
+    # Spawn points are split like the routes: over the leased routes with
+    # --coordinate, otherwise over the shards. A hash of the id keeps each
+    # one in its place when others are learned.
+    def bucket(s):
+        return zlib.crc32(s['spawnpoint_id'].encode('utf-8')) & 0xffffffff
 
-    position = (config['ORIGINAL_LATITUDE'], config['ORIGINAL_LONGITUDE'], 0)
+    if coordinator.coordinator:
+        leased = set(coordinator.coordinator.routes())
+        return [s for s in spawnpoints if bucket(s) % len(args.routes) in leased]
+    shard = getattr(args, 'shard', 0)
+    return [s for s in spawnpoints if bucket(s) % args.shards == shard]
 
-    lock = Lock()
-    with lock:
-        for r in args.routes:
-            waypoints = enumerate(generate_location_steps(r))
-            search_args = (waypoints, lock)
-            search_queue.put(search_args)
 
-    # Wait until this scan itteration queue is empty (not nessearily done)
-    while not search_queue.empty():
-        log.debug("Waiting for current search queue to complete (remaining: {})".format(search_queue.qsize()))
-        time.sleep(1)
+def spawn_routes(spawnpoints, num_routes):
+    # Spawn points within SCAN_RADIUS of an earlier one share its scan
+    locations = []
+    for s in sorted(spawnpoints, key=lambda s: (s['latitude'], s['longitude'])):
+        if not any(distance(l[0], l[1], s['latitude'], s['longitude']) <=
+                   config['SCAN_RADIUS'] for l in locations):
+            locations.append((s['latitude'], s['longitude'], 0))
 
-    # Don't let this method exit until the last item has ACTUALLY finished
-    search_queue.join()
+    waypoints = [(i, randomizeCoords(l)) for i, l in enumerate(locations)]
+    return [r for r in (waypoints[i::num_routes] for i in range(num_routes)) if r]
 
 
 #
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Sharding Architecture:
+ - The parent process spawns one process per shard and reports the
+   aggregate scan throughput
+ - Each shard process takes every Nth account and route and runs the full
+   search stack for them (account pool, engine, overseer and ingest writer),
+   writing to the shared database
+'''
+
+import logging
+import os
+import time
+import multiprocessing
+
+from threading import Thread
+from queue import Empty
+
+from . import config, search
+from .accounts import start_account_pool
+from .coordinator import start_coordinator
+from .ingest import ingest_loop
+from .webhook import start_dispatcher
+
+log = logging.getLogger(__name__)
+
+
+def start_shards(args):
+    # A shard without accounts would leave its routes unscanned
+    if args.shards > len(args.pgousers):
+        log.warning('Only {} accounts, running as many shards instead of {}.'
+                    .format(len(args.pgousers), args.shards))
+        args.shards = len(args.pgousers)
+
+    stats = multiprocessing.Queue()
+    processes = []
+    for shard in range(args.shards):
+        p = multiprocessing.Process(target=run_shard, name='shard-{}'.format(shard),
+                                    args=(shard, args, stats))
+        p.daemon = True
+        p.start()
+        processes.append(p)
+    return processes, stats
+
+
+def shard_loop(processes, stats):
+    rates = {}
+    next_report = time.time() + config['SHARD_REPORT_INTERVAL']
+    while any(p.is_alive() for p in processes):
+        try:
+            shard, rate = stats.get(timeout=max(0, next_report - time.time()))
+            rates[shard] = rate
+        except Empty:
+            pass
+
+        if time.time() >= next_report:
+            next_report += config['SHARD_REPORT_INTERVAL']
+            if not rates:
+                continue
+            log.info('{} shards scanning {:.2f} waypoints/s ({}).'.format(
+                len(rates), sum(rates.values()),
+                ', '.join('{:.2f}'.format(rates[s]) for s in sorted(rates))))
+
+    log.error('All shard processes exited.')
+
+
+def run_shard(shard, args, stats):
+    args.shard = shard
+    args.pgousers = args.pgousers[shard::args.shards]
+    # Coordinated shards lease their routes like any other node
+    if not args.coordinate:
+        args.routes = args.routes[shard::args.shards]
+    if not args.pgousers:
+        log.warning('Shard {} has no accounts, exiting.'.format(shard))
+        return
+    # Every shard writes its own token file, they would overwrite each
+    # other's tokens otherwise. Accounts stay on the same shard as long as
+    # --shards doesn't change.
+    if args.token_file:
+        root, ext = os.path.splitext(args.token_file)
+        args.token_file = '{}-{}{}'.format(root, shard, ext)
+    log.info('Shard {} scanning {} routes with {} accounts.'.format(
+        shard, len(args.routes), len(args.pgousers)))
+
+    # Threads don't survive the fork, everything is started again in here
+    if args.webhooks:
+        start_dispatcher(args)
+
+    ingest_thread = Thread(target=ingest_loop)
+    ingest_thread.daemon = True
+    ingest_thread.name = 'ingest_thread'
+    ingest_thread.start()
+
+    start_account_pool(args)
+    if args.engine == 'pool':
+        scheduler = search.create_pooled_threads(args)
+    else:
+        scheduler = search.create_search_threads(args)
+    if args.coordinate:
+        start_coordinator(args, '{}-{}'.format(args.node_id, shard), scheduler)
+
+    report_thread = Thread(target=report_loop, args=(shard, stats))
+    report_thread.daemon = True
+    report_thread.name = 'report_thread'
+    report_thread.start()
+
+    search.search_loop(args)
+
+
+def report_loop(shard, stats):
+    completed = search.scheduler.completed
+    while True:
+        time.sleep(config['SHARD_REPORT_INTERVAL'])
+        rate = float(search.scheduler.completed - completed) / config['SHARD_REPORT_INTERVAL']
+        completed = search.scheduler.completed
+        stats.put((shard, rate))
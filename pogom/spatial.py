@@ -0,0 +1,117 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import heapq
+import math
+
+from threading import Lock
+
+EARTH_RADIUS = 6371000.
+
+
+def distance(lat1, lng1, lat2, lng2):
+    # Meters between two points, equirectangular is plenty at scan range
+    x = math.radians(lng2 - lng1) * math.cos(math.radians((lat1 + lat2) / 2))
+    y = math.radians(lat2 - lat1)
+    return EARTH_RADIUS * math.hypot(x, y)
+
+
+def circle_overlap(d, r):
+    # Share of a circle of radius r covered by another one d meters away
+    if d >= 2 * r:
+        return 0.0
+    x = d / (2.0 * r)
+    return 2 / math.pi * (math.acos(x) - x * math.sqrt(1 - x * x))
+
+
+class GridIndex(object):
+    '''
+    Thread-safe in-memory index of expiring points, bucketed on a fixed
+    lat/lng grid so bounding box queries only look at nearby buckets.
+
+    Every entry is a dict with at least 'latitude' and 'longitude', stored
+    under a unique key together with the datetime it expires at. Expired
+    entries are dropped lazily whenever the index is written or queried.
+    '''
+
+    def __init__(self, cell_size=0.01):
+        self.cell_size = cell_size
+        self.enabled = False
+
+        self._lock = Lock()
+        self._cells = {}
+        self._entries = {}
+        self._expiry = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def _cell(self, lat, lng):
+        return (int(math.floor(lat / self.cell_size)),
+                int(math.floor(lng / self.cell_size)))
+
+    def add(self, key, entry, expires):
+        cell = self._cell(entry['latitude'], entry['longitude'])
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (cell, entry, expires)
+            self._cells.setdefault(cell, {})[key] = entry
+            heapq.heappush(self._expiry, (expires, key))
+
+    def remove(self, key):
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        if key not in self._entries:
+            return
+        cell = self._entries.pop(key)[0]
+        bucket = self._cells[cell]
+        del bucket[key]
+        if not bucket:
+            del self._cells[cell]
+
+    def expire(self, now):
+        with self._lock:
+            self._expire(now)
+
+    def _expire(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            expires, key = heapq.heappop(self._expiry)
+            # Keys that were re-added since carry a newer expiry on the heap
+            if key in self._entries and self._entries[key][2] == expires:
+                self._remove(key)
+
+    def all(self, now):
+        with self._lock:
+            self._expire(now)
+            return [entry for _, entry, _ in self._entries.itervalues()]
+
+    def query(self, swLat, swLng, neLat, neLng, now):
+        swLat, swLng, neLat, neLng = (float(swLat), float(swLng),
+                                      float(neLat), float(neLng))
+        sw = self._cell(swLat, swLng)
+        ne = self._cell(neLat, neLng)
+
+        with self._lock:
+            self._expire(now)
+
+            # Large viewports cover far more grid cells than are populated
+            num_cells = (ne[0] - sw[0] + 1) * (ne[1] - sw[1] + 1)
+            if num_cells > len(self._cells):
+                buckets = [b for c, b in self._cells.iteritems()
+                           if sw[0] <= c[0] <= ne[0] and
+                           sw[1] <= c[1] <= ne[1]]
+            else:
+                buckets = [self._cells[(i, j)]
+                           for i in xrange(sw[0], ne[0] + 1)
+                           for j in xrange(sw[1], ne[1] + 1)
+                           if (i, j) in self._cells]
+
+            return [e for b in buckets for e in b.itervalues()
+                    if swLat <= e['latitude'] <= neLat and
+                    swLng <= e['longitude'] <= neLng]
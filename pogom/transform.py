@@ -1,9 +1,14 @@
+import numpy as np
+
 from math import sqrt, sin, cos
 
 a = 6378245.0
 ee = 0.00669342162296594323
 pi = 3.14159265358979324
 
+# Transformed coordinates of pokestops and gyms, which never move
+fort_cache = {}
+
 
 def transform_from_wgs_to_gcj(latitude, longitude):
     if is_location_out_of_china(latitude, longitude):
@@ -43,3 +48,56 @@ def transform_long(x, y):
     lon += (20.0 * sin(x * pi) + 40.0 * sin(x / 3.0 * pi)) * 2.0 / 3.0
     lon += (150.0 * sin(x / 12.0 * pi) + 300.0 * sin(x / 30.0 * pi)) * 2.0 / 3.0
     return lon
+
+
+def transform_from_wgs_to_gcj_batch(latitudes, longitudes):
+    lat = np.asarray(latitudes, dtype=np.float64)
+    lon = np.asarray(longitudes, dtype=np.float64)
+    x, y = lon - 105.0, lat - 35.0
+
+    adjust_lat = -100.0 + 2.0 * x + 3.0 * y + 0.2 * y * y + 0.1 * x * y + 0.2 * np.sqrt(np.abs(x))
+    adjust_lat += (20.0 * np.sin(6.0 * x * pi) + 20.0 * np.sin(2.0 * x * pi)) * 2.0 / 3.0
+    adjust_lat += (20.0 * np.sin(y * pi) + 40.0 * np.sin(y / 3.0 * pi)) * 2.0 / 3.0
+    adjust_lat += (160.0 * np.sin(y / 12.0 * pi) + 320 * np.sin(y * pi / 30.0)) * 2.0 / 3.0
+
+    adjust_lon = 300.0 + x + 2.0 * y + 0.1 * x * x + 0.1 * x * y + 0.1 * np.sqrt(np.abs(x))
+    adjust_lon += (20.0 * np.sin(6.0 * x * pi) + 20.0 * np.sin(2.0 * x * pi)) * 2.0 / 3.0
+    adjust_lon += (20.0 * np.sin(x * pi) + 40.0 * np.sin(x / 3.0 * pi)) * 2.0 / 3.0
+    adjust_lon += (150.0 * np.sin(x / 12.0 * pi) + 300.0 * np.sin(x / 30.0 * pi)) * 2.0 / 3.0
+
+    rad_lat = lat / 180.0 * pi
+    magic = 1 - ee * np.sin(rad_lat) ** 2
+    sqrt_magic = np.sqrt(magic)
+    adjust_lat = (adjust_lat * 180.0) / ((a * (1 - ee)) / (magic * sqrt_magic) * pi)
+    adjust_lon = (adjust_lon * 180.0) / (a / sqrt_magic * np.cos(rad_lat) * pi)
+
+    out_of_china = ((lon < 72.004) | (lon > 137.8347) |
+                    (lat < 0.8293) | (lat > 55.8271))
+    return (np.where(out_of_china, lat, lat + adjust_lat),
+            np.where(out_of_china, lon, lon + adjust_lon))
+
+
+def transform_rows(rows, cache=None):
+    # Converts the 'latitude' and 'longitude' of every row dict in place.
+    # Coordinates found in 'cache' are reused, new ones are added to it.
+    if cache is None:
+        pending = rows
+    else:
+        pending = []
+        for row in rows:
+            key = (row['latitude'], row['longitude'])
+            if key in cache:
+                row['latitude'], row['longitude'] = cache[key]
+            else:
+                pending.append(row)
+
+    if pending:
+        lats, lons = transform_from_wgs_to_gcj_batch(
+            [row['latitude'] for row in pending],
+            [row['longitude'] for row in pending])
+        for row, lat, lon in zip(pending, lats.tolist(), lons.tolist()):
+            if cache is not None:
+                cache[(row['latitude'], row['longitude'])] = (lat, lon)
+            row['latitude'], row['longitude'] = lat, lon
+
+    return rows
@@ -5,14 +5,15 @@ import sys
 import getpass
 import configargparse
 import uuid
+import socket
 import os
 import json
 from datetime import datetime, timedelta
 import logging
 import shutil
-import requests
 
 from . import config
+from . import webhook
 
 log = logging.getLogger(__name__)
 
@@ -30,6 +31,14 @@ def verify_config_file_exists(filename):
 
 
 def get_args():
+    # Parsed once per process; every module shares the same namespace
+    if not hasattr(get_args, 'args'):
+        get_args.args = parse_args()
+
+    return get_args.args
+
+
+def parse_args():
     # fuck PEP8
     configpath = os.path.join(os.path.dirname(__file__), '../config/config.ini')
     parser = configargparse.ArgParser(default_config_files=[configpath])
@@ -41,14 +50,23 @@ def get_args():
     parser.add_argument('-st', '--step-limit', help='Steps', type=int,
                         default=12)
     parser.add_argument('-sd', '--scan-delay',
-                        help='Time delay between requests in scan threads',
+                        help='Seconds between an account\'s first requests; accounts then speed up to --max-scan-rate while the servers answer, so this is not a minimum delay (default: 5)',
                         type=float, default=5)
+    parser.add_argument('--max-scan-rate',
+                        help='Requests/s an account may speed up to while the servers answer, lower it to scan more cautiously (default: 0.5)',
+                        type=float, default=0.5)
+    parser.add_argument('--coverage-window',
+                        help='Skip waypoints another account scanned within this many seconds, 0 scans every waypoint (default: 60)',
+                        type=int, default=60)
     parser.add_argument('-td', '--thread-delay',
                         help='Time delay between each scan thread loop',
                         type=float, default=5)
     parser.add_argument('-ld', '--login-delay',
                         help='Time delay between each login attempt',
                         type=float, default=5)
+    parser.add_argument('--token-file',
+                        help='File to keep encrypted login tokens in across restarts, shards use one each with their number appended (default: tokens.json, empty to disable)',
+                        default='tokens.json')
     parser.add_argument('-dc', '--display-in-console',
                         help='Display Found Pokemon in Console',
                         action='store_true', default=False)
@@ -79,11 +97,40 @@ def get_args():
     parser.add_argument('-k', '--gmaps-key',
                         help='Google Maps Javascript API Key',
                         required=True)
+    parser.add_argument('--maps-cache',
+                        help='File to cache Google Maps geocodes and paths in (default: maps_cache.db, empty to disable)',
+                        default='maps_cache.db')
+    parser.add_argument('--maps-cache-hours',
+                        help='Refresh cached Google Maps results after this many hours (default: 720)',
+                        type=float, default=720)
+    parser.add_argument('--no-elevation',
+                        help='Skip the Google Elevation API and walk routes at altitude 0',
+                        action='store_true', default=False)
+    parser.add_argument('-wp', '--waypoints',
+                        help='Walk the routes from this waypoint file (see compile_routes.py) instead of routes.json')
     parser.add_argument('-C', '--cors', help='Enable CORS on web server',
                         action='store_true', default=False)
     parser.add_argument('-D', '--db', help='Database filename',
                         default='pogom.db')
     parser.add_argument('-t', '--num-threads', help='Number of search threads', type=int, default=1)
+    parser.add_argument('--engine', choices=['threads', 'pool'],
+                        help='Scan with one thread per account, or drive all accounts from a small pool of threads (default: threads)',
+                        default='threads')
+    parser.add_argument('--engine-threads',
+                        help='Number of threads for --engine pool (default: 8)',
+                        type=int, default=8)
+    parser.add_argument('--shards',
+                        help='Split accounts and routes over this many scanner processes (default: 1)',
+                        type=int, default=1)
+    parser.add_argument('--coordinate',
+                        help='Lease routes through the shared database, so several scanner nodes split routes.json between them',
+                        action='store_true', default=False)
+    parser.add_argument('--node-id',
+                        help='Name of this scanner node with --coordinate (default: hostname-pid)',
+                        default='{}-{}'.format(socket.gethostname(), os.getpid()))
+    parser.add_argument('--spawn-scan',
+                        help='Only visit the learned spawn points as their Pokemon appear, walking the routes until some are learned',
+                        action='store_true', default=False)
     parser.add_argument('-np', '--no-pokemon',
                         help='Disables Pokemon from the map (including parsing them into local db)',
                         action='store_true', default=False)
@@ -99,8 +146,21 @@ def get_args():
     parser.add_argument('--db-user', help='Username for the database')
     parser.add_argument('--db-pass', help='Password for the database')
     parser.add_argument('--db-host', help='IP or hostname for the database')
+    parser.add_argument('--keep-pokemon-hours',
+                        help='Delete Pokemon this many hours after they disappeared (default: keep forever)',
+                        type=float, default=0)
+    parser.add_argument('--keep-scanned-hours',
+                        help='Delete scanned locations older than this many hours (default: keep forever)',
+                        type=float, default=0)
+    parser.add_argument('--archive-file',
+                        help='Append deleted Pokemon to this gzipped JSON lines file')
     parser.add_argument('-wh', '--webhook', help='Define URL(s) to POST webhook information to',
                         nargs='*', default=False, dest='webhooks')
+    parser.add_argument('--wh-threads', help='Number of webhook sender threads',
+                        type=int, default=1)
+    parser.add_argument('--wh-batch-size',
+                        help='Send up to this many webhook messages per POST as a JSON list (default: 1, no batching)',
+                        type=int, default=1)
     parser.set_defaults(DEBUG=False)
 
     args = parser.parse_args()
@@ -179,20 +239,5 @@ def get_pokemon_name(pokemon_id):
 
 
 def send_to_webhook(message_type, message):
-    args = get_args()
-
-    data = {
-        'type': message_type,
-        'message': message
-    }
-
-    if args.webhooks:
-        webhooks = args.webhooks
-
-        for w in webhooks:
-            try:
-                requests.post(w, json=data, timeout=(None, 1))
-            except requests.exceptions.ReadTimeout:
-                log.debug('Could not receive response from webhook')
-            except requests.exceptions.RequestException as e:
-                log.debug(e)
+    if webhook.dispatcher is not None:
+        webhook.dispatcher.send(message_type, message)
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+'''
+Precompiled waypoint files, as written by compile_routes.py.
+
+Layout (little endian):
+ - header: magic 'PGWP', format version, number of routes (uint32 each)
+ - per route: number of waypoints (uint32), followed by that many latitudes,
+   longitudes and altitudes, each as a contiguous array of doubles
+'''
+
+import mmap
+import struct
+
+from . import config, maps
+
+MAGIC = 'PGWP'
+VERSION = 1
+
+_header = struct.Struct('<4sII')
+_count = struct.Struct('<I')
+_double = struct.Struct('<d')
+
+
+def get_route_waypoints(route, speed):
+    # Home, waypoint and loop destination, walked as a closed loop
+    homedest = maps.coordinates(route[0])
+    waydest = maps.coordinates(route[1])
+    loopdest = maps.coordinates(route[2])
+
+    elevation = config['MAPS_ELEVATION']
+    if elevation:
+        waypoints = [maps.getElevation(homedest)]
+    else:
+        waypoints = [tuple(homedest) + (0.0,)]
+    for origin, destination in ((homedest, waydest), (waydest, loopdest),
+                                (loopdest, homedest)):
+        waypoints.extend(maps.path(origin, destination, speed=speed,
+                                   elevation=elevation))
+    return waypoints
+
+
+def write_waypoints(filename, routes):
+    with open(filename, 'wb') as f:
+        f.write(_header.pack(MAGIC, VERSION, len(routes)))
+        for waypoints in routes:
+            f.write(_count.pack(len(waypoints)))
+            for axis in range(3):
+                f.write(struct.pack('<{}d'.format(len(waypoints)),
+                                    *[w[axis] for w in waypoints]))
+
+
+class WaypointFile(object):
+    '''
+    Memory-mapped waypoint file. Routes are read straight from the mapping
+    as they are walked, nothing is copied up front.
+    '''
+
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, num_routes = _header.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('{} is not a version {} waypoint file'.format(
+                filename, VERSION))
+
+        self.routes = []
+        offset = _header.size
+        for _ in range(num_routes):
+            num_waypoints = _count.unpack_from(self._map, offset)[0]
+            offset += _count.size
+            self.routes.append(WaypointRoute(self._map, offset, num_waypoints))
+            offset += 3 * num_waypoints * _double.size
+
+
+class WaypointRoute(object):
+
+    def __init__(self, buf, offset, num_waypoints):
+        self._buf = buf
+        self._offset = offset
+        self._num_waypoints = num_waypoints
+
+    def __len__(self):
+        return self._num_waypoints
+
+    def __getitem__(self, i):
+        if not 0 <= i < self._num_waypoints:
+            raise IndexError('waypoint index out of range')
+        stride = self._num_waypoints * _double.size
+        offset = self._offset + i * _double.size
+        return (_double.unpack_from(self._buf, offset)[0],
+                _double.unpack_from(self._buf, offset + stride)[0],
+                _double.unpack_from(self._buf, offset + 2 * stride)[0])
@@ -0,0 +1,107 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+import requests
+
+from threading import Thread, Lock
+from queue import Queue, Empty, Full
+
+from . import config
+
+log = logging.getLogger(__name__)
+
+dispatcher = None
+
+
+def start_dispatcher(args):
+    global dispatcher
+    dispatcher = WebhookDispatcher(args.webhooks, args.wh_threads,
+                                   args.wh_batch_size)
+    dispatcher.start()
+    return dispatcher
+
+
+class WebhookDispatcher(object):
+    '''
+    Delivers webhook messages from a bounded queue on background threads so
+    a slow or dead webhook consumer never blocks the search threads.
+
+    With a batch size above 1, queued messages are combined and POSTed as a
+    JSON list instead of one object per request.
+    '''
+
+    def __init__(self, urls, num_threads=1, batch_size=1):
+        self.urls = urls
+        self.num_threads = num_threads
+        self.batch_size = batch_size
+
+        self.queue = Queue(maxsize=config['WH_QUEUE_SIZE'])
+
+        self._lock = Lock()
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        for i in range(self.num_threads):
+            t = Thread(target=self._worker, name='webhook_thread-{}'.format(i))
+            t.daemon = True
+            t.start()
+
+    def send(self, message_type, message):
+        try:
+            self.queue.put_nowait({'type': message_type, 'message': message})
+        except Full:
+            with self._lock:
+                self.dropped += 1
+                dropped = self.dropped
+            if dropped % 100 == 1:
+                log.warning('Webhook queue full, {} messages dropped so far'
+                            .format(dropped))
+
+    def _worker(self):
+        # Sessions are not shared between threads, but are kept per webhook
+        # so every POST reuses an open keep-alive connection
+        sessions = dict((url, requests.Session()) for url in self.urls)
+
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            data = batch if self.batch_size > 1 else batch[0]
+            for url in self.urls:
+                if self._post(sessions[url], url, data):
+                    count = 'sent'
+                else:
+                    count = 'failed'
+                with self._lock:
+                    setattr(self, count, getattr(self, count) + len(batch))
+
+            for _ in batch:
+                self.queue.task_done()
+
+    def _post(self, session, url, data):
+        delay = 1
+        for attempt in range(config['WH_RETRIES'] + 1):
+            try:
+                r = session.post(url, json=data, timeout=config['WH_TIMEOUT'])
+                if r.status_code < 500:
+                    return True
+                log.debug('Webhook {} responded with {}'.format(
+                    url, r.status_code))
+            except requests.exceptions.RequestException as e:
+                log.debug('Could not send to webhook {}: {}'.format(url, e))
+
+            if attempt < config['WH_RETRIES']:
+                time.sleep(delay)
+                delay *= 2
+
+        log.warning('Giving up on webhook {} after {} attempts'.format(
+            url, config['WH_RETRIES'] + 1))
+        return False
@@ -13,8 +13,16 @@ from flask_cors import CORS
 from pogom import config
 from pogom.app import Pogom
 from pogom.utils import get_args, insert_mock_data
-from pogom.search import search_loop, create_search_threads, fake_search_loop
-from pogom.models import init_database, create_tables, Pokemon, Pokestop, Gym
+from pogom.search import search_loop, create_search_threads, \
+    create_pooled_threads, fake_search_loop
+from pogom.webhook import start_dispatcher
+from pogom.accounts import start_account_pool
+from pogom.shards import start_shards, shard_loop
+from pogom.coordinator import start_coordinator
+from pogom.ingest import ingest_loop
+from pogom.waypoints import WaypointFile
+from pogom.models import init_database, create_tables, load_pokemon_index, \
+    clean_database_loop, Pokemon, Pokestop, Gym
 from pogom import maps
 
 from pogom.pgoapi.utilities import get_pos_by_name
@@ -64,28 +72,72 @@ if __name__ == '__main__':
     if args.no_gyms:
         log.info('Parsing of Gyms disabled.')
 
+    config['GMAPS_KEY'] = args.gmaps_key
+    config['REQ_SLEEP'] = args.scan_delay
+    config['RATE_ACCOUNT_MAX'] = args.max_scan_rate
+    config['COVERAGE_WINDOW'] = args.coverage_window
+    config['MAPS_CACHE'] = args.maps_cache
+    config['MAPS_CACHE_TTL'] = args.maps_cache_hours * 3600
+    config['MAPS_ELEVATION'] = not args.no_elevation
+
     config['ORIGINAL_LATITUDE'] = position[0]
     config['ORIGINAL_LONGITUDE'] = position[1]
     config['LOCALE'] = args.locale
     config['CHINA'] = args.china
 
+    if args.webhooks:
+        start_dispatcher(args)
+
+    if args.keep_pokemon_hours > 0 or args.keep_scanned_hours > 0:
+        cleanup_thread = Thread(target=clean_database_loop, args=(args,))
+        cleanup_thread.daemon = True
+        cleanup_thread.name = 'cleanup_thread'
+        cleanup_thread.start()
+
     if not args.only_server:
         # Gather the pokemons!
         if not args.mock:
             route_data = json.loads(open("routes.json").read())
             routes = route_data['routes']
             pgousers = route_data['users']
+            if args.waypoints:
+                routes = WaypointFile(args.waypoints).routes
+                log.info('Loaded {} precompiled routes from {}.'.format(
+                    len(routes), args.waypoints))
             args.routes = routes
             args.pgousers = pgousers
             args.num_threads = len(pgousers)
-            log.debug('Starting a real search thread and {} search runner thread(s)'.format(args.num_threads))
-            create_search_threads(args)
-            search_thread = Thread(target=search_loop, args=(args,))
+            if args.shards > 1:
+                log.debug('Starting {} scanner processes'.format(args.shards))
+                processes, stats = start_shards(args)
+                search_thread = Thread(target=shard_loop, args=(processes, stats))
+            else:
+                log.debug('Starting a real search thread and {} search runner thread(s)'.format(args.num_threads))
+                ingest_thread = Thread(target=ingest_loop)
+                ingest_thread.daemon = True
+                ingest_thread.name = 'ingest_thread'
+                ingest_thread.start()
+                start_account_pool(args)
+                if args.engine == 'pool':
+                    scheduler = create_pooled_threads(args)
+                else:
+                    scheduler = create_search_threads(args)
+                if args.coordinate:
+                    start_coordinator(args, args.node_id, scheduler)
+                search_thread = Thread(target=search_loop, args=(args,))
         else:
             log.debug('Starting a fake search thread')
             insert_mock_data()
             search_thread = Thread(target=fake_search_loop)
 
+        # If the searcher in this process is the only one writing to the
+        # database, the webserver can answer Pokemon queries from memory.
+        # Shards, coordinated nodes and others sharing a MySQL database
+        # write Pokemon this process never sees.
+        if (args.shards <= 1 and not args.coordinate and
+                args.db_type != 'mysql'):
+            load_pokemon_index()
+
         search_thread.daemon = True
         search_thread.name = 'search_thread'
         search_thread.start()
@@ -96,8 +148,6 @@ if __name__ == '__main__':
         CORS(app);
 
     config['ROOT_PATH'] = app.root_path
-    config['GMAPS_KEY'] = args.gmaps_key
-    config['REQ_SLEEP'] = args.scan_delay
 
     if args.no_server:
         # This loop allows for ctrl-c interupts to work since flask won't be holding the program open
@@ -14,6 +14,9 @@ var notifiedPokemon = [];
 
 var map;
 var rawDataIsLoading = false;
+var rawDataParams;
+var rawDataTimestamp;
+var rawDataResets = 0;
 var locationMarker;
 var marker;
 
@@ -740,19 +743,29 @@ function loadRawData() {
   var neLat = nePoint.lat();
   var neLng = nePoint.lng();
 
+  var params = {
+    'pokemon': loadPokemon,
+    'pokestops': loadPokestops,
+    'gyms': loadGyms,
+    'scanned': loadScanned,
+    'swLat': swLat,
+    'swLng': swLng,
+    'neLat': neLat,
+    'neLng': neLng
+  };
+
+  // Only ask for changes if nothing but time has passed since the last load,
+  // otherwise (panned, zoomed, toggled a layer) fetch everything again
+  var paramsKey = $.param(params);
+  if (paramsKey === rawDataParams) {
+    params.since = rawDataTimestamp;
+  }
+  var resets = rawDataResets;
+
   return $.ajax({
     url: "raw_data",
     type: 'GET',
-    data: {
-      'pokemon': loadPokemon,
-      'pokestops': loadPokestops,
-      'gyms': loadGyms,
-      'scanned': loadScanned,
-      'swLat': swLat,
-      'swLng': swLng,
-      'neLat': neLat,
-      'neLng': neLng
-    },
+    data: params,
     dataType: "json",
     beforeSend: function() {
       if (rawDataIsLoading) {
@@ -761,12 +774,26 @@ function loadRawData() {
         rawDataIsLoading = true;
       }
     },
+    success: function(result) {
+      // A reset while this was loading still wants a full load next
+      if (resets === rawDataResets) {
+        rawDataParams = paramsKey;
+        rawDataTimestamp = result.timestamp;
+      }
+    },
     complete: function() {
       rawDataIsLoading = false;
     }
   })
 }
 
+// Markers removed client side (exclude list, lured only) won't come back
+// with a delta, the next load has to fetch everything again
+function resetRawData() {
+  rawDataParams = null;
+  rawDataResets++;
+}
+
 function processPokemons(i, item) {
   if (!Store.get('showPokemon')) {
     return false; // in case the checkbox was unchecked in the meantime.
@@ -1146,6 +1173,7 @@ $(function() {
     $selectExclude.on("change", function(e) {
       excludedPokemon = $selectExclude.val().map(Number);
       clearStaleMarkers();
+      resetRawData();
       Store.set('remember_select_exclude', excludedPokemon);
     });
     $selectNotify.on("change", function(e) {
@@ -1217,6 +1245,7 @@ $(function() {
 
   $('#lured-pokestops-only-switch').change(function() {
     Store.set("showLuredPokestopsOnly", this.value);
+    resetRawData();
     updateMap();
   });
 
@@ -0,0 +1,104 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import tempfile
+import unittest
+
+from datetime import datetime, timedelta
+
+# The models bind to the database named on the command line when imported
+_fd, DB_FILE = tempfile.mkstemp(suffix='.db')
+os.close(_fd)
+sys.argv = [sys.argv[0], '-k', 'test', '-l', '0,0', '-D', DB_FILE]
+
+from pogom import config
+from pogom.coordinator import Coordinator
+from pogom.models import init_database, create_tables, RouteLease, ScanNode
+
+
+class FakeScheduler(object):
+    completed = 0
+
+
+def node(node_id, num_routes=4, capacity=10):
+    coordinator = Coordinator(node_id, num_routes, capacity, FakeScheduler())
+    coordinator._create_leases()
+    return coordinator
+
+
+class CoordinatorTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        create_tables(init_database())
+
+    @classmethod
+    def tearDownClass(cls):
+        init_database().close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(DB_FILE + suffix):
+                os.remove(DB_FILE + suffix)
+
+    def setUp(self):
+        RouteLease.delete().execute()
+        ScanNode.delete().execute()
+
+    def test_fair_split(self):
+        a, b = node('a'), node('b')
+        a._heartbeat()
+        b._heartbeat()
+        a._heartbeat()
+        b._heartbeat()
+
+        self.assertEqual(len(a.routes()), 2)
+        self.assertEqual(len(b.routes()), 2)
+        self.assertEqual(sorted(a.routes() + b.routes()), [0, 1, 2, 3])
+
+    def test_capacity(self):
+        a = node('a', capacity=3)
+        a._heartbeat()
+        self.assertEqual(a.routes(), [0, 1, 2])
+
+    def test_release_to_late_joiner(self):
+        a = node('a')
+        a._heartbeat()
+        self.assertEqual(a.routes(), [0, 1, 2, 3])
+
+        b = node('b')
+        b._heartbeat()
+        # Everything is still leased to a, which hands back half once it
+        # sees b alive
+        self.assertEqual(b.routes(), [])
+        a._heartbeat()
+        b._heartbeat()
+
+        self.assertEqual(a.routes(), [0, 1])
+        self.assertEqual(b.routes(), [2, 3])
+        nodes = dict((n['node_id'], n['routes']) for n in ScanNode.get_nodes())
+        self.assertEqual(nodes, {'a': 2, 'b': 2})
+
+    def test_takeover_after_missed_heartbeat(self):
+        a, b = node('a'), node('b')
+        for _ in range(2):
+            a._heartbeat()
+            b._heartbeat()
+        self.assertEqual(len(b.routes()), 2)
+
+        # a stops renewing its leases
+        past = datetime.utcnow() - timedelta(seconds=config['LEASE_TTL'] + 1)
+        RouteLease.update(expires=past).where(RouteLease.node_id == 'a').execute()
+        ScanNode.update(last_heartbeat=past).where(ScanNode.node_id == 'a').execute()
+        b._heartbeat()
+
+        self.assertEqual(b.routes(), [0, 1, 2, 3])
+
+    def test_only_leases_known_routes(self):
+        a = node('a', num_routes=6)
+        b = node('b', num_routes=3)
+        b._heartbeat()
+        a._heartbeat()
+        b._heartbeat()
+
+        self.assertTrue(all(route < 3 for route in b.routes()))